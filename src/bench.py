@@ -0,0 +1,824 @@
+#/usr/bin/env python
+
+# --------------------------------------------------------
+# Micro benchmarks for block'em. Usage:
+#   python bench.py collision teardown render queue levels atlas movers actors dispatch timers sound handoff sweep
+#   python bench.py suite --out run.json --baseline base.json --threshold 0.2
+# --------------------------------------------------------
+import os, sys, time, random, math
+import gc, json, argparse, collections, weakref, zlib
+import pygame
+from pygame.locals import *
+import blockem
+
+BINDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","bin")
+
+# --------------------------------------------------------
+# A game without window nor drawing thread, data from bin/
+# --------------------------------------------------------
+def makeGame(**kw):
+    kw.setdefault("prefetch",False)
+    kw.setdefault("seed",1)
+    os.environ.setdefault("SDL_VIDEODRIVER","dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER","dummy")
+    os.chdir(BINDIR)
+    pygame.init()
+    blockem.GAME = game = blockem.GameClass("bench",(640,480),**kw)
+    if game.drawingThread:
+        game.drawingThread.ended = True
+        game.drawingThread.join()
+    return game
+
+# --------------------------------------------------------
+# Plays one level for n frames, returns the game
+# --------------------------------------------------------
+def playLevel(name,n,onframe=None,**kw):
+    game = makeGame(**kw)
+    game.curlevel = game.levels.index(name)
+    blockem.createLevel()
+    blockem.createPlayer("blocky")
+    source = blockem.RandomInput(3)
+    for f in xrange(n):
+        game.input( source.keys(f), 1/60.0 )
+        game.update(1/60.0)
+        if onframe: onframe(game)
+    return game
+
+def levelNames():
+    return sorted( l for l in os.listdir(os.path.join(BINDIR,"data","levels")) if l.endswith(".lvl") )
+
+# --------------------------------------------------------
+# Times fn over n calls, returns microseconds per call
+# --------------------------------------------------------
+def timeit(fn,n):
+    t = time.time()
+    for i in xrange(n):
+        fn(i)
+    return (time.time()-t)*1e6/n
+
+# --------------------------------------------------------
+# Reference linear scan (what GameClass.collision used to do)
+# --------------------------------------------------------
+def linearCollision(actors,o,r):
+    minor = 1e10
+    collider = None
+    for a in actors:
+        if hasattr(a,"collidable") and a.collidable:
+            if r.colliderect( a.rect ):
+                d = (o[0] - a.rect.centerx)*(o[0]-a.rect.centerx) + \
+                    (o[1] - a.rect.centery)*(o[1]-a.rect.centery)
+                if d < minor:
+                    minor = d
+                    collider = a
+    return collider
+
+# --------------------------------------------------------
+# Fake level: mostly tile blocks plus 10% of movers off the grid
+# --------------------------------------------------------
+def makeWorld(n,rnd):
+    side = int(n**0.5)+1
+    actors, index = [], blockem.CollisionIndex()
+    for i in xrange(n):
+        a = blockem.Actor()
+        a.collidable = rnd.random() > 0.05
+        a.rect = Rect( (i%side)*32, (i/side)*32, 32, 32 )
+        if rnd.random() < 0.1:
+            a.rect.move_ip( rnd.randint(-16,16), rnd.randint(-16,16) )
+        actors.append(a)
+        index.add(a)
+    return actors, index, side*32
+
+def benchCollision(sizes=(300,3000,30000),queries=2000):
+    rnd = random.Random(1)
+    print "%8s %12s %12s %8s" % ("actors","linear us","index us","speedup")
+    for n in sizes:
+        actors, index, extent = makeWorld(n,rnd)
+        rects = [ Rect( rnd.randint(0,extent), rnd.randint(0,extent), 20, 20 ) \
+                  for i in xrange(queries) ]
+        for r in rects:
+            assert linearCollision(actors,r.center,r) is index.query(r.center,r)
+        # movers shake around, as BhShaking / BhMoverBlock do in game
+        movers = [a for a in actors if a.rect.left % 32]
+        def moveAll(i):
+            for a in movers:
+                a.rect.left += 1 if i%2 else -1
+                index.sync(a)
+        tl = timeit(lambda i: linearCollision(actors,rects[i].center,rects[i]),len(rects))
+        ti = timeit(lambda i: index.query(rects[i].center,rects[i]),len(rects))
+        tm = timeit(moveAll,20)/max(len(movers),1)
+        print "%8d %12.2f %12.2f %7.0fx   (sync %.2f us/mover)" % (n,tl,ti,tl/ti,tm)
+
+# --------------------------------------------------------
+# Level teardown: every block terminated at once (stage clear)
+# --------------------------------------------------------
+def oldTeardown(actors):
+    frames = 0
+    while actors:
+        frames += 1
+        for a in actors:
+            if a.terminated:
+                actors.remove(a)
+            else:
+                a.update(0.016)
+    return frames
+
+def makeLevel(n):
+    actors = []
+    for i in xrange(n):
+        a = blockem.Actor()
+        a.collidable = True
+        a.rect = Rect( (i%100)*32, (i/100)*32, 32, 32 )
+        a.terminated = True
+        actors.append(a)
+    return actors
+
+def benchTeardown(n=10000):
+    t = time.time()
+    frames = oldTeardown( makeLevel(n) )
+    told = time.time()-t
+    g = makeGame(headless=True)
+    g.actors = makeLevel(n)
+    for a in g.actors: g.colliders.add(a)
+    t = time.time()
+    g.updateActors(0.016)
+    tnew = time.time()-t
+    assert not g.actors and not g.colliders.entries
+    group = g.openGroup("level")
+    for a in makeLevel(n):
+        a.terminated = False
+        g.addActor(a)
+        g.colliders.add(a)
+    g.closeGroup()
+    g.actors, g.newactors = g.newactors, []
+    t = time.time()
+    g.discardGroup(group)
+    tgroup = time.time()-t
+    assert not g.actors and not g.colliders.entries
+    print "teardown of %d blocks: list.remove %.1f ms over %d frames, compaction %.1f ms in 1 frame, " \
+          "group discard %.1f ms" % (n,told*1000,frames,tnew*1000,tgroup*1000)
+
+# --------------------------------------------------------
+# Full redraw vs dirty rectangles, with and without the static
+# layer. Every frame is rendered right after it's simulated, and
+# must come out the same pixels in every mode.
+# --------------------------------------------------------
+def benchRender(n=600):
+    modes = [ ("full",False,False), ("dirty",True,False), ("baked",False,True), ("baked+dirty",True,True) ]
+    print "%-6s" % "level" + "".join( "%22s" % m[0] for m in modes ) + "   (commands, px blitted, ms per frame)"
+    for name in levelNames():
+        line = "%-6s" % name[:-4]
+        shots = {}
+        for mode,dirty,bake in modes:
+            stats = { "cmds":0, "t":0.0 }
+            crcs = shots[mode] = []
+            def onframe(g):
+                if not hasattr(g,"renderer"):
+                    g.renderer = blockem.DrawingThread(g,dirty)
+                    g.renderer.screen = g.SCREEN.copy()
+                    g.renderer.countblits = True
+                stats["cmds"] += len(g.drawingbuff)
+                t = time.time()
+                g.renderer.render(g.drawingbuff)
+                stats["t"] += time.time()-t
+                crcs.append( zlib.crc32(pygame.image.tostring(g.renderer.screen,"RGB")) )
+            game = playLevel(name,n,onframe,bake=bake)
+            assert crcs == shots["full"], "%s %s: %d frames differ from full" % \
+                   (name, mode, sum( a != b for a,b in zip(crcs,shots["full"]) ))
+            line += "%6d %8d %6.3f" % (stats["cmds"]/n, game.renderer.blitarea/n, stats["t"]*1000/n)
+        print line
+
+# --------------------------------------------------------
+# Sorted (z, surface, rect) list + blit loop vs z buckets + blits
+# --------------------------------------------------------
+def benchQueue(sizes=(1000,10000),frames=20):
+    game = makeGame()
+    rnd = random.Random(1)
+    images = [ game.loadImage(i) for i in ("wblock","yblock","rblock","lblock","t0","blocky") ]
+    print "%8s %12s %12s %12s %12s" % ("sprites","sort ms","buckets ms","blit ms","blits ms")
+    for n in sizes:
+        cmds = [ (rnd.choice((0,0,0,7,8,9,10)), rnd.choice(images), \
+                  Rect(rnd.randint(0,620),rnd.randint(0,460),32,32)) for i in xrange(n) ]
+        t = time.time()
+        for f in xrange(frames):
+            buff = []
+            for c in cmds: buff.append(c)
+            buff.sort()
+        tsort = (time.time()-t)*1000/frames
+        t = time.time()
+        for f in xrange(frames):
+            q = blockem.RenderQueue()
+            for c in cmds: q.add(c[0],c[1],c[2])
+        tbuck = (time.time()-t)*1000/frames
+        t = time.time()
+        for f in xrange(frames):
+            for a in buff: game.SCREEN.blit( a[1], a[2] )
+        tblit = (time.time()-t)*1000/frames
+        t = time.time()
+        for f in xrange(frames):
+            for b in q.buckets:
+                if b: blockem.blitAll( game.SCREEN, b )
+        tblits = (time.time()-t)*1000/frames
+        print "%8d %12.3f %12.3f %12.3f %12.3f" % (n,tsort,tbuck,tblit,tblits)
+
+# --------------------------------------------------------
+# Level switch latency: the switch frames, execfile + eval per tile
+# (how BhLevel.loadLevel used to work) vs compiled levels, and
+# cold levels prepared by the prefetcher while playing. Every other
+# switch clears the stage instead of F5 (the switch comes from the
+# actor pass then), and the old blocks must be gone when the next
+# level loads.
+# --------------------------------------------------------
+def oldCreateBlock(bd,pos,bhs=[]):
+    actor = blockem.createBlock(bd,pos)
+    for b in bhs:
+        actor.addBehavior( eval(b,vars(blockem),{"actor":actor}) )
+    return actor
+
+def oldLoadLevel(self):
+    GAME = blockem.GAME
+    filedef = {}
+    execfile( GAME.nextLevel(), filedef )
+    mapdesc,mapdefs,mapinfo = filedef["MAP"], filedef["MAPDEFS"], filedef["INFO"]
+    self.updateLevelInfo( str(GAME.curlevel%len(GAME.levels))+":"+mapinfo["name"] )
+    self.remainBlocks = 0
+    self.blocks = GAME.openGroup("level")
+    for x in range(-1,21):
+        oldCreateBlock( "t", pos=(x*32,14*32) )
+    for y in range(0,15):
+        for x in range(0,20):
+            b = mapdesc[y][x]
+            if b in ["w","l","b","y","r","m","t","k","p"]:
+                oldCreateBlock( b, pos=(x*32,y*32) )
+            elif b == "s":
+                GAME.spawnpoint = (x*32,y*32)
+            elif mapdefs.has_key(b):
+                defs = mapdefs[b]
+                b = defs[0]
+                oldCreateBlock( b, pos=(x*32,y*32), bhs=defs[1] )
+            if b == "w" : self.remainBlocks += 1
+    GAME.closeGroup()
+    GAME.sendMessage( blockem.Message(blockem.MSG_PLAYERSPAWN) )
+
+def benchLevels(switches=50):
+    modes = [ ("execfile+eval",oldLoadLevel,None), ("compiled cold",None,"cold"),
+              ("compiled disk",None,"disk"), ("compiled warm",None,"warm"), ("prefetched",None,"prefetch") ]
+    load = blockem.BhLevel.loadLevel
+    print "%-14s %10s %10s %12s   (ms for the level switch frames, max is the worst case)" % \
+          ("","median","max","loadLevel")
+    for mode,loader,cache in modes:
+        loading, old = [], []
+        def timedLoad(self,loader=loader or load):
+            assert not [ r for r in old if r() is not None ], "blocks of the last level still alive"
+            t = time.time()
+            loader(self)
+            loading.append( time.time()-t )
+            old[:] = [ weakref.ref(a) for a in self.blocks.actors ]
+        blockem.BhLevel.loadLevel = timedLoad
+        try:
+            game = makeGame(prefetch = cache == "prefetch")
+            blockem.createLevel()
+            blockem.createPlayer("blocky")
+            times = []
+            for i in xrange(switches):
+                clear = i%2
+                if clear: # back in play, then "Stage Clear!" waiting for space, the level number moves on
+                    game.input( blockem.KeyState([K_SPACE]), 1/60.0 )
+                    game.update(1/60.0)
+                    game.sendMessage( blockem.Message(blockem.MSG_LASTBLOCK) )
+                    game.input( blockem.KeyState(), 1/60.0 )
+                    game.update(1/60.0)
+                path = os.path.join( "data/levels", game.levels[(game.curlevel+1-clear)%len(game.levels)] )
+                if cache in ("cold","disk","prefetch"): game.LEVELCACHE.clear()
+                if cache in ("cold","prefetch") and os.path.exists(path+"c"): os.remove(path+"c")
+                if cache == "prefetch":
+                    game.prefetcher.request(path)
+                    game.prefetcher.requests.join()
+                gc.collect()
+                gc.disable() # the old level has to go by refcount
+                t = time.time()
+                game.input( blockem.KeyState([K_SPACE] if clear else [K_F5]), 1/60.0 )
+                game.update(1/60.0)
+                game.input( blockem.KeyState(), 1/60.0 ) # the next level is built here
+                game.update(1/60.0)
+                times.append( time.time()-t )
+                gc.enable()
+                for f in xrange(40):
+                    game.input( blockem.KeyState(), 1/60.0 )
+                    game.update(1/60.0)
+            game.destroy()
+        finally:
+            blockem.BhLevel.loadLevel = load
+        print "%-14s %10.3f %10.3f %12.3f" % (mode, percentile(times,0.5)*1000, max(times)*1000,
+                                              percentile(loading,0.5)*1000)
+
+# --------------------------------------------------------
+# Loose image files vs the atlas: file probes and opens to load
+# every sprite, and blitting a level's worth of sprites
+# --------------------------------------------------------
+def benchAtlas(sprites=2000,frames=50):
+    game = makeGame()
+    atlas = game.ATLAS
+    names = sorted(atlas)
+    exists, load = os.path.exists, pygame.image.load
+    rnd = random.Random(1)
+    picks = [ (rnd.choice(names),(rnd.randint(0,600),rnd.randint(0,440))) for i in xrange(sprites) ]
+    print "%-8s %8s %8s %10s %10s" % ("","probes","opens","load ms","blit ms")
+    for mode,manifest in (("files",{}),("atlas",atlas)):
+        calls = { "probes":0, "opens":0 }
+        def countExists(p): calls["probes"] += 1; return exists(p)
+        def countLoad(*a): calls["opens"] += 1; return load(*a)
+        os.path.exists, pygame.image.load = countExists, countLoad
+        try:
+            game.ATLAS, game.IMAGECACHE = manifest, blockem.SurfaceCache(8*1024*1024)
+            t = time.time()
+            images = dict( (n,game.loadImage(n)) for n in names )
+            tload = (time.time()-t)*1000
+        finally:
+            os.path.exists, pygame.image.load = exists, load
+        cmds = [ (images[n],p) for n,p in picks ]
+        t = time.time()
+        for f in xrange(frames): game.SCREEN.blits(cmds,0)
+        print "%-8s %8d %8d %10.3f %10.3f" % (mode,calls["probes"],calls["opens"],tload,(time.time()-t)*1000/frames)
+
+# --------------------------------------------------------
+# n moving blocks (the bottom row kind: mover + drawing), headless
+# frames with BhMoverBlock vs the numpy MoverSystem, and the mover
+# pass alone (the updates, or the system writing every actor)
+# --------------------------------------------------------
+def benchMovers(sizes=(1000,10000),frames=60):
+    print "%8s %12s %12s %12s %12s" % ("blocks","scalar ms","numpy ms","movers only","numpy")
+    for n in sizes:
+        times, moving = [], []
+        for vec in (False,True):
+            game = makeGame(headless=True,vectorize=vec)
+            rnd = random.Random(1)
+            for i in xrange(n):
+                blockem.createBlock( "t", pos=(rnd.randint(0,600),rnd.randint(0,440)) )
+            game.update(1/60.0)
+            gc.collect()
+            gc.disable()
+            t = time.time()
+            for f in xrange(frames): game.update(1/60.0)
+            times.append( (time.time()-t)*1000/frames )
+            gc.enable()
+            movers = [ b for a in game.actors for b in a.behaviors if isinstance(b,blockem.BhMoverBlock) ]
+            t = time.time()
+            for f in xrange(frames):
+                if vec: game.movers.update(1/60.0)
+                for b in movers: b.update(1/60.0)
+            moving.append( (time.time()-t)*1000/frames )
+        print "%8d %12.3f %12.3f %12.3f %12.3f" % (n,times[0],times[1],moving[0],moving[1])
+
+# --------------------------------------------------------
+# Actor footprint: bytes of the actor and behavior objects of a
+# block (instances, attribute dicts, behavior lists and dispatch
+# tables, not the shared surfaces) and actor updates per second
+# --------------------------------------------------------
+def objectBytes(o):
+    d = getattr(o,"__dict__",None)
+    return sys.getsizeof(o) + (sys.getsizeof(d) if d is not None else 0)
+
+def actorBytes(a):
+    tables = [ a.updaters, a.handlers ] if hasattr(a,"updaters") else []
+    return objectBytes(a) + sys.getsizeof(a.behaviors) + sys.getsizeof(a.added) + \
+           sum( objectBytes(b) for b in a.behaviors ) + \
+           sum( sys.getsizeof(t) + sum(sys.getsizeof(f) for f in t) for t in tables )
+
+def benchActors(n=5000,frames=60,kinds="wbyrkpt"):
+    game = makeGame(headless=True)
+    for i in xrange(n):
+        blockem.createBlock( kinds[i%len(kinds)], pos=((i%20)*32,(i/20%14)*32) )
+    game.update(1/60.0)
+    blocks = list(game.actors)
+    size = sum( actorBytes(a) for a in blocks )/float(len(blocks))
+    gc.collect()
+    gc.disable()
+    t = time.time()
+    for f in xrange(frames):
+        for a in blocks: a.update(1/60.0)
+    tu = time.time()-t
+    t = time.time()
+    for f in xrange(frames): game.update(1/60.0)
+    tf = (time.time()-t)*1000/frames
+    gc.enable()
+    print "%8s %12s %14s %10s" % ("blocks","bytes/actor","updates/s","frame ms")
+    print "%8d %12.0f %14.0f %10.3f" % (len(blocks),size,len(blocks)*frames/tu,tf)
+
+# --------------------------------------------------------
+# Behavior dispatch on the shipped levels: attribute lookups per
+# frame of the old probing loops (terminated / update / message
+# read on every behavior each pass) against the dispatch tables
+# (no lookup per behavior, the lookups move to relink), counted
+# from the behaviors each pass visits. Ended behaviors still in
+# the tables after the run (dead) must be none.
+# --------------------------------------------------------
+def deadBehaviors(game):
+    return sum( sum(1 for b in a.behaviors if b.terminated) + a.updaters.count(blockem.nop) + \
+                a.handlers.count(blockem.nop) for a in game.actors )
+
+def benchDispatch(frames=1200):
+    A = blockem.Actor
+    update, send, relink, unlink = A.update, A.sendMessage, A.relink, A.unlink
+    counts = collections.Counter()
+    def countUpdate(a,dt):
+        for b in a.behaviors:
+            counts["probe"] += 1 if b.terminated else (2 if b.update is None else 3)
+        update(a,dt)
+    def countSend(a,msg):
+        for b in a.behaviors:
+            counts["probe"] += 1 if b.message is None else (2 if b.terminated else 3)
+        send(a,msg)
+    def countRelink(a):
+        counts["relinks"] += 1
+        for b in a.behaviors:
+            counts["table"] += 1 if b.terminated else \
+                3 + (b.update is not None) + (b.message is not None)
+        relink(a)
+    def countUnlink(a,b):
+        counts["table"] += 2
+        unlink(a,b)
+    print "%-8s %14s %14s %12s %8s" % ("level","probing/frame","tables/frame","relinks","dead")
+    A.update, A.sendMessage, A.relink, A.unlink = countUpdate, countSend, countRelink, countUnlink
+    try:
+        for name in levelNames():
+            counts.clear()
+            game = playLevel(name,frames)
+            dead = deadBehaviors(game)
+            print "%-8s %14.0f %14.1f %12.2f %8d" % (name[:-4],counts["probe"]/float(frames),
+                                                 counts["table"]/float(frames),counts["relinks"]/float(frames),dead)
+            assert dead == 0, "ended behaviors left in dispatch tables"
+    finally:
+        A.update, A.sendMessage, A.relink, A.unlink = update, send, relink, unlink
+
+# --------------------------------------------------------
+# Countdown blocks (gestures, shaking, turning, alternating), idle
+# between their events: frame time, behavior updates and timers
+# fired per frame, and the countdowns alone (their updates, or the
+# timer wheel). Every "r" block shakes once first; by the end idle
+# blocks must be left with nothing to update but their drawing.
+# --------------------------------------------------------
+COUNTDOWNS = ("BhGestureBlock","BhShaking","BhShake","BhTurningBlock","BhAlternateDeath")
+
+def benchTimers(sizes=(1000,10000),frames=300):
+    kinds = [ ("y",()), ("r",()), ("l",[("BhTurningBlock",(),{})]),
+              ("k",[("BhAlternateDeath",("kblock","lblock"),{})]) ]
+    print "%8s %10s %14s %12s %14s" % ("blocks","frame ms","updates/frame","fired/frame","countdowns ms")
+    for n in sizes:
+        game = makeGame(headless=True)
+        rnd = random.Random(1)
+        for i in xrange(n):
+            kind, bhs = kinds[i%len(kinds)]
+            blockem.createBlock( kind, pos=(rnd.randint(0,600),rnd.randint(0,440)), bhs=bhs )
+        game.update(1/60.0)
+        updates = sum( 1 for a in game.actors for b in a.behaviors if b.update is not None )
+        for a in game.actors:
+            for b in a.behaviors:
+                if isinstance(b,blockem.BhShaking):
+                    b.cancelTimer()
+                    b.shake()
+        fired = game.timers.fired if hasattr(game,"timers") else 0
+        gc.collect()
+        gc.disable()
+        t = time.time()
+        for f in xrange(frames): game.update(1/60.0)
+        tf = (time.time()-t)*1000/frames
+        gc.enable()
+        fired = (game.timers.fired-fired)/float(frames) if hasattr(game,"timers") else 0.0
+        busy = [ a for a in game.actors if [ f for f in a.updaters if f != a.behaviors[-1].update ] ]
+        assert not busy, "%d idle blocks still updated each frame" % len(busy)
+        counting = [ b for a in game.actors for b in a.behaviors \
+                     if type(b).__name__ in COUNTDOWNS and b.update is not None ]
+        t = time.time()
+        for f in xrange(frames):
+            if hasattr(game,"timers"):
+                game.now += 1/60.0
+                game.timers.advance(game.now)
+            for b in counting: b.update(1/60.0)
+        tc = (time.time()-t)*1000/frames
+        print "%8d %10.3f %14d %12.2f %14.3f" % (n,tf,updates,fired,tc)
+
+# --------------------------------------------------------
+# Sound bursts in real time: a bounce click every frame, a death
+# and a stage bell now and then. The old single 0.1 s gate against
+# the voice manager: cues played and time per playSound call.
+# --------------------------------------------------------
+def oldPlaySound(game,gate,name,vol=1.0):
+    if gate[0] <= 0.0:
+        sound = game.loadSound(name)
+        sound.set_volume(vol)
+        sound.play()
+        gate[0] = 0.1
+        return True
+    return False
+
+def benchSound(frames=300,dt=1/60.0):
+    os.environ.setdefault("SDL_AUDIODRIVER","dummy")
+    pygame.mixer.quit()
+    pygame.mixer.pre_init(blockem.MIXER_FREQ,-16,2,blockem.MIXER_BUFFER)
+    game = makeGame()
+    if not game.voices:
+        print "no mixer, sound bench skipped"
+        return
+    script = [ ["click"] + (["xp"] if f%37 == 0 else []) + (["bell"] if f%101 == 50 else []) for f in xrange(frames) ]
+    print "%-8s %8s %8s %8s %10s %10s" % ("","clicks","xp","bells","mean us","max us")
+    for mode in ("gate","voices"):
+        gate, played, calls = [0.0], collections.Counter(), []
+        for names in script:
+            game.now += dt
+            gate[0] -= dt
+            for name in names:
+                t = time.time()
+                if mode == "gate": ok = oldPlaySound(game,gate,name,0.1)
+                else: ok = game.voices.play(name,game.loadSound(name),0.1,game.now)
+                calls.append( time.time()-t )
+                if ok: played[name] += 1
+            time.sleep(dt)
+        pygame.mixer.stop()
+        asked = collections.Counter( n for names in script for n in names )
+        print "%-8s %8s %8s %8s %10.1f %10.1f" % ( mode,
+              "%d/%d" % (played["click"],asked["click"]), "%d/%d" % (played["xp"],asked["xp"]),
+              "%d/%d" % (played["bell"],asked["bell"]), sum(calls)*1e6/len(calls), max(calls)*1e6 )
+    print "voices: plays/drops/steals", game.voices.totals()
+    game.destroy()
+
+# --------------------------------------------------------
+# Game thread to drawing thread handoff, in real time: the old
+# shared queue (live rects, each thread on its own 60 Hz clock)
+# vs the frame exchange with the renderer at 60 and 144 fps. A
+# frame is torn when what's drawn isn't what was published, a
+# duplicate when it's drawn again unchanged, dropped when never.
+# --------------------------------------------------------
+class OldQueue:
+    def __init__(self):
+        self.buckets = [ [] for z in xrange(blockem.MAXZ+1) ]
+        self.background, self.seq = None, 0
+    def add(self,z,surf,rect,key=None):
+        self.buckets[z].append( (surf,rect) )
+    def discard(self,keys):
+        pass
+    def __len__(self):
+        return sum( len(b) for b in self.buckets )
+
+def rectsOf(q):
+    return [ tuple(c[1]) for b in q.buckets for c in b ]
+
+def benchHandoff(seconds=3.0):
+    print "%-10s %6s %8s %8s %10s %8s %8s %8s" % \
+          ("","fps","steps","drawn","duplicate","torn","dropped","interp")
+    for mode,fps in (("old",60),("exchange",60),("exchange",144)):
+        game = makeGame()
+        renderer = blockem.DrawingThread(game,fps=fps)
+        snaps, shown, stats = {}, set(), collections.Counter()
+        if mode == "old":
+            game.commandbuff = OldQueue()
+            renderer.drawingbuff = OldQueue()
+            def update(dt):
+                game.updateActors(dt)
+                game.commandbuff.background = game.staticLayer.flush()
+                game.commandbuff.seq = len(snaps)+1
+                snaps[game.commandbuff.seq] = rectsOf(game.commandbuff)
+                renderer.drawingbuff = game.drawingbuff = game.commandbuff
+                game.commandbuff = OldQueue()
+            def run():
+                while not renderer.ended:
+                    renderer.clock.tick(60)
+                    renderer.render(renderer.drawingbuff)
+            game.update, renderer.run = update, run
+        else:
+            publish = game.exchange.publish
+            def snapPublish(frame):
+                snaps[game.exchange.seq+1] = rectsOf(frame)
+                return publish(frame)
+            game.exchange.publish = snapPublish
+        render, last = renderer.render, [None]
+        def checked(queue,prev=None,alpha=1.0):
+            render(queue,prev,alpha)
+            if queue.seq not in snaps: return
+            stats["drawn"] += 1
+            stats["duplicate"] += last[0] == (queue.seq,alpha)
+            stats["torn"] += rectsOf(queue) != snaps[queue.seq]
+            last[0] = (queue.seq,alpha)
+            shown.add(queue.seq)
+        renderer.render = checked
+        blockem.createLevel()
+        blockem.createPlayer("blocky")
+        source = blockem.RandomInput(5)
+        renderer.start()
+        f, lag, t = 0, 0.0, time.time()
+        end = t+seconds
+        while t < end:
+            now = time.time()
+            lag, t = lag+now-t, now
+            while lag >= blockem.SIMSTEP:
+                lag -= blockem.SIMSTEP
+                game.input( source.keys(f), blockem.SIMSTEP )
+                game.update( blockem.SIMSTEP )
+                f += 1
+            time.sleep( max(blockem.SIMSTEP-lag,0.0) )
+        renderer.ended = True
+        renderer.join()
+        print "%-10s %6d %8d %8d %10d %8d %8d %8d" % (mode, fps, f, stats["drawn"], stats["duplicate"],
+              stats["torn"], len(snaps)-len(shown), renderer.interpolated)
+        game.destroy()
+
+# --------------------------------------------------------
+# Tunneling at coarser ticks: every level played for the same sim
+# time at growing dt, with the overlap test alone (no sweep) and
+# with the swept test. A tunnel is a step without collision whose
+# straight path went over a pixel deep into a block it didn't start
+# in, checked pixel by pixel along the way.
+# --------------------------------------------------------
+def tunneled(game,x0,y0,x1,y1,size):
+    start = Rect( (x0,y0), size )
+    n = int( max(math.fabs(x1-x0),math.fabs(y1-y0)) )+1
+    for i in xrange(1,n+1):
+        x, y = x0+(x1-x0)*i/n, y0+(y1-y0)*i/n
+        r = Rect( (x,y), size ).inflate(-2,-2)
+        for a in game.colliders.entries:
+            if a.collidable and r.colliderect(a.rect) and not start.colliderect(a.rect): return True
+    return False
+
+def benchSweep(seconds=40.0,dts=(1/60.0,1/30.0,1/15.0,1/10.0)):
+    print "%8s %-8s %8s %10s %10s %10s" % ("dt","test","steps","collisions","tunnels","ticks/s")
+    for dt in dts:
+        for mode in ("overlap","sweep"):
+            stats, el = collections.Counter(), 0.0
+            for name in levelNames():
+                game = makeGame()
+                game.curlevel = game.levels.index(name)
+                if mode == "overlap": game.sweep = lambda *args: None
+                post = game.postMessage
+                def counted(msg):
+                    if msg.id == blockem.MSG_UPDATEBOUNCES: stats["collisions"] += 1
+                    post(msg)
+                game.postMessage = counted
+                blockem.createLevel()
+                blockem.createPlayer("blocky")
+                source = blockem.RandomInput(4)
+                t = time.time()
+                for f in xrange( int(seconds/dt) ):
+                    pl = [ a for a in game.actors if a.points is not None ]
+                    moving = pl and any( isinstance(b,blockem.BhPlayer) for b in pl[0].behaviors )
+                    if moving: x0, y0, c = pl[0].x, pl[0].y, stats["collisions"]
+                    game.input( source.keys(f), dt )
+                    game.update( dt )
+                    stats["steps"] += 1
+                    if moving and c == stats["collisions"] and not pl[0].terminated and \
+                       tunneled( game, x0, y0, pl[0].x, pl[0].y, pl[0].rect.size ):
+                        stats["tunnels"] += 1
+                el += time.time()-t
+                game.destroy()
+            print "%8.4f %-8s %8d %10d %10d %10.0f" % (dt, mode, stats["steps"], stats["collisions"],
+                  stats["tunnels"], stats["steps"]/max(el,1e-9))
+
+# --------------------------------------------------------
+# Gameplay suite: plays every shipped level with scripted keys and
+# times each phase of the frame. Phases are timed by wrapping the
+# game's own methods, exclusive of the phases nested inside them.
+# --------------------------------------------------------
+PHASES = ("input","actors","collision","messages","drawlist","blit","flip")
+
+class PhaseClock:
+    def __init__(self):
+        self.stack = []
+        self.frame = dict.fromkeys(PHASES,0.0)
+        self.counts = collections.defaultdict(int)
+
+    def wrap(self,phase,fn,counter=None):
+        def timed(*args):
+            if counter: self.counts[counter] += 1
+            self.stack.append(0.0)
+            t = time.time()
+            try:
+                return fn(*args)
+            finally:
+                el = time.time()-t
+                self.frame[phase] += el-self.stack.pop()
+                if self.stack: self.stack[-1] += el
+        return timed
+
+    def next(self):
+        f, self.frame = self.frame, dict.fromkeys(PHASES,0.0)
+        return f
+
+def percentile(values,p):
+    v = sorted(values)
+    return v[ int(round(p*(len(v)-1))) ] if v else 0.0
+
+def summary(values,scale=1.0):
+    return { "median":percentile(values,0.5)*scale, "p99":percentile(values,0.99)*scale,
+             "mean":sum(values)*scale/max(len(values),1), "max":max(values or [0])*scale }
+
+def playSuite(name,frames,dt=1/60.0):
+    game = makeGame()
+    game.curlevel = game.levels.index(name)
+    clock = PhaseClock()
+    renderer = blockem.DrawingThread(game)
+    game.input = clock.wrap("input",game.input)
+    game.update = clock.wrap("drawlist",game.update)
+    game.updateActors = clock.wrap("actors",game.updateActors)
+    game.collision = clock.wrap("collision",game.collision)
+    game.sweep = clock.wrap("collision",game.sweep)
+    game.bus.publish = clock.wrap("messages",game.bus.publish,"messages")
+    game.bus.drain = clock.wrap("messages",game.bus.drain)
+    render = clock.wrap("blit",renderer.render)
+    flip, update = pygame.display.flip, pygame.display.update
+    pygame.display.flip = clock.wrap("flip",flip)
+    pygame.display.update = clock.wrap("flip",update)
+    try:
+        blockem.createLevel()
+        blockem.createPlayer("blocky")
+        source = blockem.RandomInput(3)
+        clock.next(), clock.counts.clear()
+        res = dict( (k,[]) for k in ("frame","netobjs","population","messages") + PHASES )
+        gc.collect()
+        gc.disable()
+        for f in xrange(frames):
+            c = gc.get_count()[0]
+            t = time.time()
+            game.input( source.keys(f), dt )
+            game.update(dt)
+            render(game.drawingbuff)
+            res["frame"].append( time.time()-t )
+            res["netobjs"].append( gc.get_count()[0]-c ) # created less freed, gc is off
+            res["population"].append( len(game.actors) )
+            res["messages"].append( clock.counts.pop("messages",0) )
+            for k,v in clock.next().items(): res[k].append(v)
+            if f % 100 == 99: gc.collect()
+    finally:
+        gc.enable()
+        pygame.display.flip, pygame.display.update = flip, update
+    return { "frame_ms":summary(res["frame"],1000.0),
+             "phases_ms":dict( (p,summary(res[p],1000.0)) for p in PHASES ),
+             "net_gc_objects_per_frame":summary(res["netobjs"]),
+             "actors":summary(res["population"]),
+             "messages_per_frame":summary(res["messages"]) }
+
+# regressions of run against base, timings under floor ms are noise
+def compare(run,base,threshold,floor=0.01):
+    worse = []
+    for lvl,cur in sorted(run["levels"].items()):
+        old = base["levels"].get(lvl)
+        if not old: continue
+        checks = [ ("frame_ms."+k, cur["frame_ms"][k], old["frame_ms"][k]) for k in ("median","p99") ]
+        checks += [ ("phases_ms.%s.median" % p, cur["phases_ms"][p]["median"], old["phases_ms"][p]["median"]) \
+                    for p in PHASES ]
+        for metric,c,o in checks:
+            if c > o*(1.0+threshold) and c-o > floor:
+                worse.append( (lvl,metric,o,c) )
+        c, o = cur["net_gc_objects_per_frame"]["mean"], old["net_gc_objects_per_frame"]["mean"]
+        if c > o*(1.0+threshold) and c-o > 1.0:
+            worse.append( (lvl,"net_gc_objects_per_frame.mean",o,c) )
+    return worse
+
+def benchSuite(frames,out,baseline,threshold,save):
+    run = { "frames":frames, "dt":1/60.0, "pygame":pygame.version.ver, "levels":{} }
+    print "%-6s %10s %10s" % ("level","median ms","p99 ms") + "".join( "%10s" % p for p in PHASES ) + \
+          "%9s %8s %8s" % ("net_objs","actors","msgs")
+    for name in levelNames():
+        r = run["levels"][name[:-4]] = playSuite(name,frames)
+        print "%-6s %10.3f %10.3f" % (name[:-4],r["frame_ms"]["median"],r["frame_ms"]["p99"]) + \
+              "".join( "%10.3f" % r["phases_ms"][p]["median"] for p in PHASES ) + \
+              "%9.1f %8d %8.2f" % (r["net_gc_objects_per_frame"]["mean"],r["actors"]["max"],
+                                  r["messages_per_frame"]["mean"])
+    if out:
+        json.dump(run, open(out,"w"), indent=1, sort_keys=True)
+    if baseline and save:
+        json.dump(run, open(baseline,"w"), indent=1, sort_keys=True)
+        print "baseline saved to", baseline
+    elif baseline and os.path.exists(baseline):
+        worse = compare(run, json.load(open(baseline)), threshold)
+        for w in worse:
+            print "REGRESSION %s %s: %.3f -> %.3f" % w
+        if worse:
+            sys.exit(1)
+        print "no regression over %d%% against %s" % (threshold*100,baseline)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="block'em benchmarks")
+    parser.add_argument("benches", nargs="*", default=["collision","teardown","render","queue","levels","atlas","movers","actors","dispatch","timers","sound","handoff","sweep"],
+                        help="collision, teardown, render, queue, levels, atlas, movers, actors, dispatch, timers, sound, handoff, sweep, suite")
+    parser.add_argument("--frames", type=int, default=1200, help="frames per level (suite)")
+    parser.add_argument("--out", help="write the suite results to this json file")
+    parser.add_argument("--baseline", help="json baseline to compare the suite against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown, 0.2 = 20%%")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    args = parser.parse_args()
+    what = args.benches
+    # makeGame changes into bin/
+    args.out = args.out and os.path.abspath(args.out)
+    args.baseline = args.baseline and os.path.abspath(args.baseline)
+    if "collision" in what: benchCollision()
+    if "teardown" in what: benchTeardown()
+    if "render" in what: benchRender()
+    if "queue" in what: benchQueue()
+    if "levels" in what: benchLevels()
+    if "atlas" in what: benchAtlas()
+    if "movers" in what and blockem.numpy: benchMovers()
+    if "actors" in what: benchActors()
+    if "dispatch" in what: benchDispatch()
+    if "timers" in what: benchTimers()
+    if "sound" in what: benchSound()
+    if "handoff" in what: benchHandoff()
+    if "sweep" in what: benchSweep()
+    if "suite" in what: benchSuite(args.frames,args.out,args.baseline,args.threshold,args.save_baseline)
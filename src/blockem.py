@@ -1,10 +1,16 @@
 #/usr/bin/env python
 
 #Import Modules
-import os, pygame, copy
-import math, random
+import os, sys, pygame, copy
+import math, random, time
+import collections, argparse
+import ast, marshal, struct, zlib
 from pygame.locals import *
-import threading
+import threading, Queue
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 if not pygame.font : print "Warning, pygame 'font' module disabled!"
 if not pygame.mixer: print "Warning, pygame 'sound' module disabled!"
@@ -20,52 +26,1103 @@ def clamp(x,m,M):
 GAME = None # Global GAME variable
 
 # --------------------------------------------------------
-# This thread in charge of rendering to pygame display
+# Message types, interned to small ints once at import time.
+# Coalescable types merge while waiting in the deferred queue:
+# REPLACE keeps only the latest, SUM adds up the values.
 # --------------------------------------------------------
+MSGTYPES, MSGCOALESCE = {}, {}
+COALESCE_REPLACE, COALESCE_SUM = 1, 2
+def msgType(name,coalesce=None):
+    if not MSGTYPES.has_key(name):
+        MSGTYPES[name] = len(MSGTYPES)
+        if coalesce: MSGCOALESCE[MSGTYPES[name]] = coalesce
+    return MSGTYPES[name]
+
+MSG_COLLISION      = msgType("collision")
+MSG_NODEATH        = msgType("nodeath")
+MSG_TURN2YELLOW    = msgType("turn2yellow")
+MSG_TURN2DEATH     = msgType("turn2death")
+MSG_UPDATEPOINTS   = msgType("updatepoints")
+MSG_UPDATEBOUNCES  = msgType("updatebounces",COALESCE_REPLACE)
+MSG_UPDATEREMAINS  = msgType("updateremains",COALESCE_SUM)
+MSG_UPDPLAYERSTATS = msgType("updplayerstats",COALESCE_REPLACE)
+MSG_PLAYERDIE      = msgType("playerdie")
+MSG_PLAYERSPAWN    = msgType("playerspawn")
+MSG_BLASTPLAYER    = msgType("blastplayer")
+MSG_LASTBLOCK      = msgType("lastblock")
+MSG_STAGECLEAR     = msgType("stageclear")
+
+# --------------------------------------------------------
+# A message. value carries points/bounces/remains/power.
+# --------------------------------------------------------
+class Message(object):
+    __slots__ = ("id","player","vec","value","org")
+    def __init__(self,id,player=None,vec=None,value=0,org=None):
+        self.id, self.player, self.vec, self.value, self.org = id, player, vec, value, org
+
+# --------------------------------------------------------
+# Global message bus. Behaviors subscribe to the types they
+# handle, so a message only visits its own listeners.
+# post() defers a message until drain(), called once per frame.
+# --------------------------------------------------------
+class MessageBus:
+    def __init__(self,deferred=True):
+        self.subs = {} # type -> [behaviors]
+        self.depth = 0
+        self.dirty = set()
+        self.deferred = deferred
+        self.queue, self.queued = [], {} # queued: type -> coalescable msg
+        self.peak, self.coalesced = 0, 0
+
+    def subscribe(self,b,types):
+        for t in types:
+            if self.subs.has_key(t): self.subs[t].append(b)
+            else: self.subs[t] = [b]
+
+    def publish(self,msg):
+        subs = self.subs.get(msg.id)
+        if not subs: return
+        self.depth += 1
+        for i in xrange(len(subs)): # late subscribers wait for the next one
+            b = subs[i]
+            if b.terminated or b.actor.terminated:
+                self.dirty.add(msg.id)
+            else:
+                b.message(msg)
+        self.depth -= 1
+        if self.depth == 0 and self.dirty:
+            self.compact()
+
+    def post(self,msg):
+        if not self.deferred:
+            self.publish(msg)
+            return
+        mode = MSGCOALESCE.get(msg.id)
+        if mode:
+            q = self.queued.get(msg.id)
+            if q is not None:
+                if mode == COALESCE_SUM: q.value += msg.value
+                else: q.player, q.vec, q.value, q.org = msg.player, msg.vec, msg.value, msg.org
+                self.coalesced += 1
+                return
+            self.queued[msg.id] = msg
+        self.queue.append(msg)
+        self.peak = max(self.peak,len(self.queue))
+
+    # handlers may post again, those go out in the same drain
+    def drain(self):
+        while self.queue:
+            queue = self.queue
+            self.queue, self.queued = [], {}
+            for msg in queue:
+                self.publish(msg)
+
+    # every behavior of these actors stops listening. Lists are rebuilt,
+    # not edited, so a publish iterating one is not disturbed.
+    def unsubscribeActors(self,actors):
+        for t,subs in self.subs.items():
+            self.subs[t] = [b for b in subs if b.actor not in actors]
+
+    # drops dead listeners, never while a publish is iterating
+    def compact(self):
+        for t in self.dirty:
+            self.subs[t] = [b for b in self.subs[t] if not b.terminated and not b.actor.terminated]
+        self.dirty = set()
+
+# --------------------------------------------------------
+# Hierarchical timer wheel of callbacks at absolute sim times.
+# Times are bucketed in ticks of res seconds; a level of the wheel
+# has 2**bits slots, each slot of a level spanning a whole turn of
+# the level below, which it is cascaded into when that turn starts.
+# A frame only visits the slots of the ticks it went through, so its
+# cost follows the timers due, not the timers pending.
+# --------------------------------------------------------
+class TimerWheel:
+    def __init__(self,res=1/120.0,bits=6,levels=3):
+        self.res, self.bits, self.mask = res, bits, (1<<bits)-1
+        self.wheels = [ [ [] for i in xrange(1<<bits) ] for l in xrange(levels) ]
+        self.overflow = [] # beyond the last level
+        self.tick = 0      # next tick to visit, the current one is visited again
+        self.now = 0.0
+        self.seq = 0
+        self.fired = 0
+
+    # timer = [time, seq, fn, args], seq keeps ties in scheduling order
+    def schedule(self,t,fn,*args):
+        self.seq += 1
+        timer = [t, self.seq, fn, args]
+        self.insert(timer)
+        return timer
+
+    def cancel(self,timer):
+        timer[2], timer[3] = None, ()
+
+    def insert(self,timer):
+        d = max( int(timer[0]/self.res), self.tick )
+        delta = d - self.tick
+        for l in xrange(len(self.wheels)):
+            if delta >> (self.bits*(l+1)) == 0:
+                self.wheels[l][ (d >> (self.bits*l)) & self.mask ].append(timer)
+                return
+        self.overflow.append(timer)
+
+    # fires, in time order, the timers due at sim time now. Timers they
+    # schedule wait for the next call even if due already.
+    def advance(self,now):
+        self.now = now
+        last = int(now/self.res)
+        due = []
+        while self.tick <= last:
+            t = self.tick
+            for l in xrange(1,len(self.wheels)):
+                if t & ((1 << (self.bits*l))-1): break
+                wheel, i = self.wheels[l], (t >> (self.bits*l)) & self.mask
+                slot, wheel[i] = wheel[i], []
+                for timer in slot: self.insert(timer)
+            else:
+                if t & ((1 << (self.bits*len(self.wheels)))-1) == 0:
+                    slot, self.overflow = self.overflow, []
+                    for timer in slot: self.insert(timer)
+            i = t & self.mask
+            due += self.wheels[0][i]
+            self.wheels[0][i] = []
+            self.tick += 1
+        self.tick = last # timers later in this tick, or scheduled for it from now on
+        fire = []
+        for timer in due:
+            if timer[2] is None: continue
+            if timer[0] <= now: fire.append(timer)
+            else: self.insert(timer)
+        fire.sort()
+        for timer in fire:
+            fn, args = timer[2], timer[3]
+            if fn is not None: # an earlier one may cancel it
+                self.cancel(timer)
+                self.fired += 1
+                fn(*args)
+
+# --------------------------------------------------------
+# One frame of drawing commands, with a bucket of (surface, rect)
+# per z order. Insertion order is kept within a z, so a frame is
+# already in drawing order and never needs sorting. Rects are
+# copied: their owners go on moving while the frame is drawn.
+# keys says who drew each command (id of the actor, None for HUD
+# and overlays), to interpolate it from the previous frame. Ids and
+# not the actors: frames linger in the exchange and the renderer,
+# and would keep a discarded level alive.
+# --------------------------------------------------------
+MAXZ = 15
+class RenderQueue:
+    def __init__(self):
+        self.buckets = [ [] for z in xrange(MAXZ+1) ]
+        self.keys = [ [] for z in xrange(MAXZ+1) ]
+        self.background = None # (surface, rect, generation) from the static layer
+        self.seq, self.stamp = 0, 0.0 # frame number and wall time, set when published
+        self.where = None # key -> topleft, see positions
+
+    def add(self,z,surf,rect,key=None):
+        self.buckets[z].append( (surf,Rect(rect)) )
+        self.keys[z].append( None if key is None else id(key) )
+
+    # removes the commands drawn by any of these actors
+    def discard(self,actors):
+        ids = set( id(a) for a in actors )
+        for z in xrange(MAXZ+1):
+            if self.buckets[z]:
+                kept = [ (c,k) for c,k in zip(self.buckets[z],self.keys[z]) if k not in ids ]
+                self.buckets[z], self.keys[z] = [ c for c,k in kept ], [ k for c,k in kept ]
+
+    # emptied to be filled again, see FrameExchange
+    def clear(self):
+        for b in self.buckets: del b[:]
+        for k in self.keys: del k[:]
+        self.background, self.where = None, None
+
+    # key -> topleft it was drawn at in this frame
+    def positions(self):
+        if self.where is None:
+            self.where = dict( (k,c[1].topleft) for b,ks in zip(self.buckets,self.keys) \
+                               for c,k in zip(b,ks) if k is not None )
+        return self.where
+
+    def __len__(self):
+        return sum( len(b) for b in self.buckets ) + (self.background != None)
+
+# --------------------------------------------------------
+# Triple buffered handoff of frames from the game thread to the
+# drawing thread, without locks: deque append and popleft are
+# atomic, and each frame is only ever in one place. The game
+# thread fills its back frame and publishes it as ready, taking
+# back a stale ready frame the renderer didn't get to (dropped).
+# The renderer takes the ready frame as its front, keeping the
+# previous front to interpolate from, and releases the one before
+# to be filled again. Frames are numbered as they're published.
+# --------------------------------------------------------
+class FrameExchange:
+    def __init__(self):
+        self.ready = collections.deque() # published, at most one
+        self.free = collections.deque()  # released by the renderer
+        self.seq = 0
+        self.published, self.dropped = 0, 0
+
+    # game thread: returns the (empty) frame to fill next
+    def publish(self,frame):
+        self.seq += 1
+        frame.seq, frame.stamp = self.seq, time.time()
+        try:
+            self.free.append( self.ready.popleft() )
+            self.dropped += 1
+        except IndexError: pass
+        self.ready.append( frame )
+        self.published += 1
+        try:
+            back = self.free.popleft()
+            back.clear()
+        except IndexError:
+            back = RenderQueue()
+        return back
+
+    # game thread: takes back the frame not drawn yet and empties the
+    # free ones, nothing of a discarded level stays in them
+    def purge(self):
+        try:
+            self.free.append( self.ready.popleft() )
+            self.dropped += 1
+        except IndexError: pass
+        for frame in list(self.free): frame.clear()
+
+    # drawing thread: the newest frame since the last take, or None
+    def take(self):
+        try: return self.ready.popleft()
+        except IndexError: return None
+
+    def release(self,frame):
+        self.free.append( frame )
+
+def blitAll(screen,cmds):
+    if hasattr(screen,"blits"): # pygame 1.9.4+
+        screen.blits(cmds,0)
+    else:
+        for c in cmds: screen.blit( c[0], c[1] )
+
+# --------------------------------------------------------
+# This thread in charge of rendering to pygame display, at fps
+# (the display rate) while the game steps at SIMSTEP. It draws
+# between the last two frames: sprites slide from where they were
+# in the previous one to where they are in the newest one as the
+# time since it was published goes by. Nothing is drawn while
+# there's no new frame and the newest one is already on screen.
+# In dirty mode only the regions whose draw commands changed since
+# the last frame are repainted and presented, unless more than
+# maxdirty of the screen changed, then it's a full redraw + flip.
+# --------------------------------------------------------
+SNAP = 48 # px, sprites moving further in one step jump there
 class DrawingThread(threading.Thread):    
-    def __init__(self,game):        
+    def __init__(self,game,dirty=False,maxdirty=0.5,fps=60):        
         threading.Thread.__init__(self)
         self.game = game
-        self.drawingbuff = []
+        self.screen = game.SCREEN
         self.ended = False
         self.clock = pygame.time.Clock()
+        self.fps = fps
+        self.dirty, self.maxdirty = dirty, maxdirty
+        self.onscreen = None # (z, surface, rect tuple) per command last presented
+        self.bggen = None    # static layer generation last presented
+        self.frames, self.fullframes, self.blitarea = 0, 0, 0
+        self.idle, self.interpolated = 0, 0
+        self.countblits = False
                 
     def run(self):
+        exchange = self.game.exchange
+        prev, cur, alpha = None, None, 1.0
         while not self.ended:
-            self.clock.tick(60)
-            self.game.SCREEN.fill((0,0,0))
-            for a in self.drawingbuff:
-                self.game.SCREEN.blit( a[1], a[2] )            
-            pygame.display.flip() # pygame flip
-    
-    def flip(self,buff):
-        self.drawingbuff = buff
-        
+            self.clock.tick(self.fps)
+            frame = exchange.take()
+            if frame is not None:
+                if prev is not None: exchange.release(prev)
+                prev, cur = cur, frame
+            elif cur is None or alpha >= 1.0:
+                self.idle += 1
+                continue
+            alpha = 1.0
+            if prev is not None:
+                alpha = min( (time.time()-cur.stamp)/max(cur.stamp-prev.stamp,0.001), 1.0 )
+            self.render(cur,prev,alpha)
+
+    # buckets of queue, sprites alpha of the way from prev
+    def place(self,queue,prev,alpha):
+        if prev is None or alpha >= 1.0: return queue.buckets
+        self.interpolated += 1
+        before = prev.positions()
+        buckets = []
+        for b,keys in zip(queue.buckets,queue.keys):
+            cmds = []
+            for c,k in zip(b,keys):
+                p = before.get(k)
+                if p:
+                    r = c[1]
+                    dx, dy = r.left-p[0], r.top-p[1]
+                    if (dx or dy) and abs(dx) <= SNAP and abs(dy) <= SNAP:
+                        c = ( c[0], r.move( int(round(dx*(alpha-1))), int(round(dy*(alpha-1))) ) )
+                cmds.append( c )
+            buckets.append( cmds )
+        return buckets
+
+    def render(self,queue,prev=None,alpha=1.0):
+        screen = self.screen
+        self.frames += 1
+        buckets = self.place(queue,prev,alpha)
+        bg = queue.background
+        bggen = bg[2] if bg else None
+        if self.dirty:
+            frame = [ (z, s, (r.left,r.top,r.width,r.height)) \
+                      for z in xrange(MAXZ+1) for s,r in buckets[z] ]
+            if self.onscreen is not None:
+                changed = set(frame).symmetric_difference(self.onscreen)
+                rects = [ Rect(c[2]) for c in changed ]
+                if bggen != self.bggen: # the background changed, only where it was damaged
+                    damage = None
+                    if bggen != None and self.bggen != None:
+                        damage = self.game.staticLayer.damageSince(self.bggen)
+                    if damage is None: rects = None
+                    else: rects += damage
+                self.bggen = bggen
+                self.onscreen = frame
+                if rects is None: rects = [self.game.SCREENRECT]
+                if not rects: return
+                area = sum( r.width*r.height for r in rects )
+                if area <= self.maxdirty*self.game.SCREENRECT.width*self.game.SCREENRECT.height:
+                    cmds = [ (f[1],Rect(f[2])) for f in frame ]
+                    allrects = [ c[1] for c in cmds ]
+                    for r in rects:
+                        screen.set_clip(r)
+                        if bg: screen.blit( bg[0], r, r )
+                        else:  screen.fill( (0,0,0) )
+                        hits = [ cmds[i] for i in r.collidelistall(allrects) ]
+                        blitAll( screen, hits )
+                        if self.countblits:
+                            self.blitarea += r.width*r.height*(1+len(hits))
+                    screen.set_clip(None)
+                    pygame.display.update(rects)
+                    return
+            self.onscreen = frame
+        self.bggen = bggen
+        self.fullframes += 1
+        if bg: screen.blit( bg[0], bg[1] )
+        else:  screen.fill( (0,0,0) )
+        for b in buckets:
+            if b: blitAll( screen, b )
+        if self.countblits:
+            self.blitarea += sum( r.width*r.height for b in buckets for s,r in b ) + \
+                             (bg != None)*self.game.SCREENRECT.width*self.game.SCREENRECT.height
+        pygame.display.flip() # pygame flip
+
 # --------------------------------------------------------
-# Main Game class
+# Background worker preparing levels before they're entered:
+# the compiled level and its images, see GameClass.prepareLevel.
+# Requests come from a level switch, so it waits a bit for that
+# frame to end instead of fighting the game thread for the GIL.
+# --------------------------------------------------------
+class LevelPrefetcher(threading.Thread):
+    def __init__(self,game,delay=0.1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.game, self.delay = game, delay
+        self.requests = Queue.Queue()
+        self.ready = {}     # path -> (mtime, level, {image name: surface})
+
+    def request(self,path):
+        if not self.ready.has_key(path): self.requests.put(path)
+
+    def take(self,path):
+        return self.ready.pop(path,None)
+
+    def stop(self):
+        self.requests.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            path = self.requests.get()
+            try:
+                if path is None: break
+                time.sleep(self.delay)
+                if not self.ready.has_key(path):
+                    self.ready[path] = self.game.prepareLevel(path)
+            finally:
+                self.requests.task_done()
+
+# --------------------------------------------------------
+# Static layer: sprites that haven't changed for a few frames are
+# composited into one background surface instead of being drawn
+# every frame. A baked sprite that moves, swaps image or hides goes
+# back to the dynamic layer until it settles again. The background
+# is drawn under everything, so only z orders <= maxz get baked, and
+# not a sprite that overlaps one drawn dynamically before it in the
+# frame (nothing draws below z 0, so those are at its z or lower).
+# --------------------------------------------------------
+BACKZ = -1
+class StaticLayer:
+    def __init__(self,rect,settle=2,maxz=0):
+        self.rect = rect
+        self.surface = pygame.Surface(rect.size)
+        if pygame.display.get_surface(): self.surface = self.surface.convert()
+        self.published = None
+        self.buffers = [] # [surface, gen] published copies, recycled once no frame holds them
+        self.settle, self.maxz = settle, maxz
+        self.baked, self.settling = {}, {} # actor -> sprite state
+        self.drawn, self.order = [], {}    # this frame: dynamic rects so far, actor -> keep call
+        self.damage = []
+        self.gen = 0
+        self.log, self.logfrom = [], 0 # (gen, rect), complete for gens > logfrom
+
+    # True when the actor is drawn by the background this frame
+    def keep(self,a):
+        if a.zord > self.maxz: return False
+        r = a.rect
+        st = (a.image, r.left, r.top, r.width, r.height)
+        self.order[a] = len(self.order)
+        if r.collidelist(self.drawn) >= 0: # baked, it would go under them
+            self.drop(a)
+        else:
+            b = self.baked.get(a)
+            if b is not None:
+                if b == st: return True
+                self.unbake(a)
+            s = self.settling.get(a)
+            n = s[1]+1 if s and s[0] == st else 0
+            if n >= self.settle:
+                self.settling.pop(a,None)
+                self.baked[a] = st
+                self.damage.append( Rect(st[1:]) )
+                return True
+            self.settling[a] = (st,n)
+        self.drawn.append( Rect(r) )
+        return False
+
+    def unbake(self,a):
+        st = self.baked.pop(a)
+        self.damage.append( Rect(st[1:]) )
+
+    def drop(self,a):
+        if self.baked.has_key(a): self.unbake(a)
+        self.settling.pop(a,None)
+
+    # many actors at once, repainting the whole background if needed
+    def dropAll(self,actors):
+        baked = False
+        for a in actors:
+            baked = self.baked.pop(a,None) is not None or baked
+            self.settling.pop(a,None)
+        if baked: self.damage.append( Rect(self.rect) )
+
+    # repaints the damaged regions, returns the background draw command
+    def flush(self):
+        if self.damage:
+            items = sorted( self.baked.items(), key=lambda i: (i[0].zord, self.order.get(i[0],0)) )
+            rects = [ Rect(st[1:]) for a,st in items ]
+            self.gen += 1
+            if len(self.damage) > 64:
+                self.surface.fill((0,0,0))
+                for i in xrange(len(items)):
+                    self.surface.blit( items[i][1][0], rects[i] )
+                self.log, self.logfrom = [], self.gen
+            else:
+                for d in self.damage:
+                    self.surface.set_clip(d)
+                    self.surface.fill((0,0,0))
+                    for i in d.collidelistall(rects):
+                        self.surface.blit( items[i][1][0], rects[i] )
+                    self.log.append( (self.gen,d) )
+                self.surface.set_clip(None)
+                if len(self.log) > 256:
+                    self.logfrom = self.log[-256][0]
+                    self.log = [ l for l in self.log if l[0] > self.logfrom ]
+            self.damage = []
+            self.published = self.publish()
+        self.drawn, self.order = [], {}
+        if not self.baked: return None
+        return (self.published, self.rect, self.gen)
+
+    # a copy of the surface for the frames to hold on to. The drawing
+    # thread may still be showing older ones, so a buffer is only
+    # reused when nothing but this list refers to it, and then only
+    # the regions damaged since it was published are copied again
+    def publish(self):
+        for b in self.buffers:
+            if sys.getrefcount(b[0]) == 2:
+                damage = self.damageSince(b[1])
+                if damage is None: b[0].blit( self.surface, (0,0) )
+                else:
+                    for d in damage: b[0].blit( self.surface, d, d )
+                b[1] = self.gen
+                return b[0]
+        self.buffers.append( [self.surface.copy(), self.gen] )
+        return self.buffers[-1][0]
+
+    # regions repainted after generation gen, None if that's too old
+    def damageSince(self,gen):
+        if gen < self.logfrom: return None
+        return [ Rect(r) for g,r in self.log if g > gen ]
+
+# --------------------------------------------------------
+# Collision broad-phase. Blocks sitting exactly on a 32px tile go in a
+# tile table (one lookup), everything else (movers, chasers, turning
+# blocks) goes in a uniform spatial hash re-bucketed only when its rect
+# changes.
+# --------------------------------------------------------
+class CollisionIndex:
+    def __init__(self,tile=32,cell=64):
+        self.tile, self.cell = tile, cell
+        self.tiles, self.cells = {}, {}
+        self.entries = {} # actor -> (rect key, table, keys, order)
+        self.order = 0
+
+    def add(self,a):
+        if not self.entries.has_key(a):
+            self.order += 1
+            self.entries[a] = (None, None, (), self.order)
+            self.sync(a)
+
+    def remove(self,a):
+        e = self.entries.pop(a,None)
+        if e: self.unlink(a,e)
+
+    def removeAll(self,actors):
+        if len(actors) >= len(self.entries) and actors.issuperset(self.entries):
+            self.tiles, self.cells, self.entries = {}, {}, {}
+        else:
+            for a in actors: self.remove(a)
+
+    def unlink(self,a,e):
+        for k in e[2]:
+            bucket = e[1][k]
+            bucket.remove(a)
+            if not bucket: del e[1][k]
+
+    # re-buckets the actor if its rect moved since last time
+    def sync(self,a):
+        e = self.entries.get(a)
+        if e is None: return
+        r = a.rect
+        rk = (r.left, r.top, r.width, r.height)
+        if e[0] == rk: return
+        self.unlink(a,e)
+        t = self.tile
+        if r.width == t and r.height == t and r.left % t == 0 and r.top % t == 0:
+            table, keys = self.tiles, ((r.left//t, r.top//t),)
+        else:
+            table, keys = self.cells, self.span(r,self.cell)
+        for k in keys:
+            if table.has_key(k): table[k].append(a)
+            else: table[k] = [a]
+        self.entries[a] = (rk, table, keys, e[3])
+
+    def span(self,r,s):
+        return tuple( (x,y) for x in range(r.left//s, (r.right-1)//s+1) \
+                            for y in range(r.top//s, (r.bottom-1)//s+1) )
+
+    # same result as a linear scan: closest center wins, ties go to the
+    # actor that entered the world first
+    def query(self,o,r):
+        minor, collider, corder = 1e10, None, 0
+        for table,s in ((self.tiles,self.tile),(self.cells,self.cell)):
+            for k in self.span(r,s):
+                for a in table.get(k,()):
+                    if a.collidable and r.colliderect( a.rect ):
+                        d = (o[0] - a.rect.centerx)*(o[0]-a.rect.centerx) + \
+                            (o[1] - a.rect.centery)*(o[1]-a.rect.centery)
+                        if d < minor or (d == minor and self.entries[a][3] < corder):
+                            minor = d
+                            collider, corder = a, self.entries[a][3]
+        return collider
+
+    # First actor hit by the box (x,y,w,h) moving by (dx,dy), as
+    # (toi, normal, actor): toi is the fraction of the move made when
+    # they touch, normal the face hit, (-1,0) for its left one. Same
+    # ties as query at the point of contact. Actors the box already
+    # overlaps are query's business, they're skipped, and so are grazes
+    # up to a pixel deep (the box never enters the actor shrunk by a
+    # pixel), which Rect overlaps at the end of a step mostly miss too.
+    def sweep(self,x,y,w,h,dx,dy):
+        box = Rect( int(math.floor(min(x,x+dx))), int(math.floor(min(y,y+dy))), 0, 0 )
+        box.size = ( int(math.ceil(max(x,x+dx)+w))-box.left, int(math.ceil(max(y,y+dy)+h))-box.top )
+        best, bestkey = None, None
+        for table,s in ((self.tiles,self.tile),(self.cells,self.cell)):
+            for k in self.span(box,s):
+                for a in table.get(k,()):
+                    if not a.collidable: continue
+                    r = a.rect
+                    if x < r.right and x+w > r.left and y < r.bottom and y+h > r.top: continue
+                    ix0, ix1 = slab( x, w, dx, r.left+1, r.right-1 )
+                    iy0, iy1 = slab( y, h, dy, r.top+1, r.bottom-1 )
+                    t = max(ix0,iy0)
+                    if t >= min(ix1,iy1) or t < 0.0 or t > 1.0: continue
+                    tx0, tx1 = slab( x, w, dx, r.left, r.right )
+                    ty0, ty1 = slab( y, h, dy, r.top, r.bottom )
+                    t = max(tx0,ty0,0.0)
+                    cx, cy = x+dx*t+w/2.0-r.centerx, y+dy*t+h/2.0-r.centery
+                    key = ( t, cx*cx+cy*cy, self.entries[a][3] )
+                    if bestkey is None or key < bestkey:
+                        n = (-1 if dx > 0 else 1, 0) if tx0 > ty0 else (0, -1 if dy > 0 else 1)
+                        best, bestkey = (t, n, a), key
+        return best
+
+# times the interval [p,p+size) moving by d overlaps [lo,hi), as
+# fractions of d, unbounded when it doesn't move
+def slab(p,size,d,lo,hi):
+    if d > 0: return (lo-p-size)/float(d), (hi-p)/float(d)
+    if d < 0: return (hi-p)/float(d), (lo-p-size)/float(d)
+    if p < hi and p+size > lo: return -1e30, 1e30
+    return 1e30, -1e30
+
+# --------------------------------------------------------
+# Fixed capacity pool of recyclable effect actors. Terminated
+# effects come back to the free list when the actor list is
+# compacted. With every slot live, POOL_REUSE_OLDEST restarts
+# the oldest effect and POOL_DROP skips the new one.
+# --------------------------------------------------------
+POOL_REUSE_OLDEST, POOL_DROP = 0, 1
+class EffectPool:
+    def __init__(self,build,capacity=32,policy=POOL_REUSE_OLDEST):
+        self.build = build # makes a fresh pooled actor
+        self.capacity, self.policy = capacity, policy
+        self.free, self.live = [], []
+        self.hits, self.misses, self.drops, self.reused = 0, 0, 0, 0
+
+    def acquire(self):
+        if self.free:
+            self.hits += 1
+            actor = self.free.pop()
+            GAME.addActor( actor )
+        else:
+            self.misses += 1
+            if len(self.live) < self.capacity:
+                actor = self.build()
+                actor.pool = self
+                GAME.addActor( actor )
+            elif self.policy == POOL_DROP:
+                self.drops += 1
+                return None
+            else:
+                self.reused += 1
+                actor = self.live.pop(0) # still in the world, restarts in place
+        actor.terminated = False
+        self.live.append( actor )
+        return actor
+
+    def release(self,actor):
+        self.live.remove( actor )
+        self.free.append( actor )
+
+    def stats(self):
+        return { "hits":self.hits, "misses":self.misses, "drops":self.drops, "reused":self.reused,
+                 "live":len(self.live), "free":len(self.free) }
+
+# --------------------------------------------------------
+# Sound voices on reserved mixer channels. Each sound has a
+# priority and a minimum gap between two of its plays; with every
+# channel busy the lowest priority, oldest voice is stolen, unless
+# all of them outrank the new one. The mixer buffer is set before
+# pygame.init: 512 samples at 22050 Hz is ~23 ms of latency.
+# --------------------------------------------------------
+MIXER_FREQ, MIXER_BUFFER = 22050, 512
+SOUNDS = { # name -> (priority, min gap in seconds)
+    "click" : (0, 0.05),
+    "bell"  : (2, 0.5),
+    "xp"    : (2, 0.2),
+}
+
+class VoiceManager:
+    def __init__(self,channels=8,sounds=SOUNDS):
+        pygame.mixer.set_num_channels(channels)
+        pygame.mixer.set_reserved(channels) # Sound.play() elsewhere can't take them
+        self.channels = [ pygame.mixer.Channel(i) for i in xrange(channels) ]
+        self.voices = [ (0,-1.0,None) ]*channels # (priority, start, name) last played there, unknown ones stolen first
+        self.sounds = sounds
+        self.last = {} # name -> time of its last play
+        self.counts = collections.defaultdict(lambda: [0,0,0]) # name -> [plays, drops, steals]
+
+    def play(self,name,sound,vol,now):
+        prio, gap = self.sounds.get(name,(1,0.1))
+        count = self.counts[name]
+        if now - self.last.get(name,-gap) < gap:
+            count[1] += 1
+            return None
+        i = self.freeChannel()
+        if i is None:
+            i = min( xrange(len(self.voices)), key=lambda j: self.voices[j][:2] )
+            if self.voices[i][0] > prio:
+                count[1] += 1
+                return None
+            self.channels[i].stop()
+            count[2] += 1
+        ch = self.channels[i]
+        ch.play(sound)
+        ch.set_volume(vol)
+        self.voices[i] = (prio, now, name)
+        self.last[name] = now
+        count[0] += 1
+        return ch
+
+    def freeChannel(self):
+        for i in xrange(len(self.channels)):
+            if not self.channels[i].get_busy(): return i
+        return None
+
+    # plays, drops, steals over every sound
+    def totals(self):
+        return [ sum(c[k] for c in self.counts.values()) for k in xrange(3) ]
+
+# --------------------------------------------------------
+# LRU cache of surfaces bounded by a byte budget. Pinned
+# surfaces count toward the budget but are never evicted.
+# --------------------------------------------------------
+class SurfaceCache:
+    def __init__(self,budget):
+        self.budget, self.used = budget, 0
+        self.entries = collections.OrderedDict()
+        self.pinned = {}
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def get(self,key):
+        surf = self.pinned.get(key)
+        if surf is not None:
+            self.hits += 1
+            return surf
+        surf = self.entries.pop(key,None)
+        if surf is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries[key] = surf # most recent goes last
+        return surf
+
+    def put(self,key,surf,pinned=False):
+        for table in (self.pinned, self.entries): # replacing, pinned or not
+            if table.has_key(key): self.used -= surfaceBytes( table.pop(key) )
+        if pinned: self.pinned[key] = surf
+        else: self.entries[key] = surf
+        self.used += surfaceBytes(surf)
+        while self.used > self.budget and len(self.entries) > 1:
+            k,old = self.entries.popitem(last=False)
+            self.used -= surfaceBytes(old)
+            self.evictions += 1
+
+    def stats(self):
+        return { "hits":self.hits, "misses":self.misses, "evictions":self.evictions,
+                 "entries":len(self.entries)+len(self.pinned), "bytes":self.used }
+
+# a subsurface (an atlas sprite) only counts its own pixels, its
+# pitch is the whole sheet's
+def surfaceBytes(surf):
+    if surf.get_parent() is not None:
+        return surf.get_width()*surf.get_height()*surf.get_bytesize()
+    return surf.get_pitch()*surf.get_height()
+
+# --------------------------------------------------------
+# Key state from a program instead of the keyboard. Indexed
+# by key like pygame.key.get_pressed()
+# --------------------------------------------------------
+class KeyState:
+    def __init__(self,down=()):
+        self.down = set(down)
+    def __getitem__(self,k):
+        return k in self.down
+
+# --------------------------------------------------------
+# Input source pressing random arrows/space every few frames,
+# always the same sequence for a given seed
+# --------------------------------------------------------
+class RandomInput:
+    def __init__(self,seed=0,period=20,p=0.35,keys=(K_LEFT,K_RIGHT,K_UP,K_DOWN,K_SPACE)):
+        self.rnd = random.Random(seed)
+        self.period, self.p, self.choices = period, p, keys
+        self.state = KeyState()
+    def keys(self,frame):
+        if frame % self.period == 0:
+            self.state = KeyState( k for k in self.choices if self.rnd.random() < self.p )
+        return self.state
+
+# --------------------------------------------------------
+# Input recording: a header with the rng seed and the level, then
+# per frame a little endian uint16 with the recorded keys as bits.
+# Bit 15 means a float64 dt follows (only when dt changed), bit 14
+# a uint32 world checksum (every `every` frames, after update).
+# --------------------------------------------------------
+RECMAGIC, RECVERSION = "BKRP", 4 # a recording only replays on the simulation that made it
+RECKEYS = (K_LEFT,K_RIGHT,K_UP,K_DOWN,K_SPACE,K_ESCAPE,K_F3,K_F4,K_F5)
+REC_DT, REC_CHECK = 0x8000, 0x4000
+
+class InputRecorder:
+    def __init__(self,path,seed,level,every=60):
+        self.f = open(path,"wb")
+        self.f.write( struct.pack("<4sBIHB",RECMAGIC,RECVERSION,seed,every,len(level)) + level )
+        self.every, self.frame, self.dt = every, 0, None
+        self.frames = 0
+
+    # one frame, after its update
+    def step(self,keys,dt,game):
+        bits = 0
+        for i in xrange(len(RECKEYS)):
+            if keys[RECKEYS[i]]: bits |= 1<<i
+        self.frame += 1
+        check = self.frame % self.every == 0
+        if dt != self.dt: bits |= REC_DT
+        if check: bits |= REC_CHECK
+        out = struct.pack("<H",bits)
+        if dt != self.dt: out += struct.pack("<d",dt)
+        if check: out += struct.pack("<I",game.checksum())
+        self.f.write(out)
+        self.dt = dt
+
+    def close(self):
+        self.f.close()
+
+class InputReplay:
+    def __init__(self,path):
+        data = open(path,"rb").read()
+        magic, version, self.seed, self.every, n = struct.unpack_from("<4sBIHB",data)
+        if magic != RECMAGIC:
+            raise ValueError("not a block'em recording: "+path)
+        if version != RECVERSION:
+            raise ValueError("recording made by another version of the game: "+path)
+        self.level = data[12:12+n]
+        self.data, self.pos = data, 12+n
+        self.frame, self.dt, self.expected = 0, None, None
+        self.checks, self.diverged = 0, None # first frame that didn't match
+
+    # (keys, dt) of the next frame, None at the end
+    def read(self):
+        if self.pos >= len(self.data): return None
+        try:
+            bits, = struct.unpack_from("<H",self.data,self.pos)
+            self.pos += 2
+            if bits & REC_DT:
+                self.dt, = struct.unpack_from("<d",self.data,self.pos)
+                self.pos += 8
+            self.expected = None
+            if bits & REC_CHECK:
+                self.expected, = struct.unpack_from("<I",self.data,self.pos)
+                self.pos += 4
+        except struct.error:
+            return None # cut short, the recording game was killed
+        self.frame += 1
+        return KeyState( RECKEYS[i] for i in xrange(len(RECKEYS)) if bits & (1<<i) ), self.dt
+
+    # compares the world with the recording, after the frame's update
+    def verify(self,game):
+        if self.expected is None: return True
+        self.checks += 1
+        if game.checksum() == self.expected: return True
+        if self.diverged is None:
+            self.diverged = self.frame
+            print "replay diverged at frame", self.frame
+        return False
+
+    def report(self):
+        print "replay: %d frames, %d checksums, %s" % (self.frame, self.checks,
+              "diverged at frame %d" % self.diverged if self.diverged else "identical")
+
+# --------------------------------------------------------
+# Sprite atlas. buildAtlas packs the images of a data folder in
+# shelves on one or more sheets, and writes a manifest with a
+# "name sheet x y w h" line per image. Rebuild it when an image
+# changes: at runtime names are resolved only through the manifest.
+# --------------------------------------------------------
+ATLASMANIFEST = "atlas.txt"
+
+def loadManifest(datadir):
+    atlas = {}
+    path = os.path.join(datadir,ATLASMANIFEST)
+    if os.path.exists(path):
+        for l in open(path):
+            name, sheet, x, y, w, h = l.split()
+            atlas[name] = ( sheet, Rect(int(x),int(y),int(w),int(h)) )
+    return atlas
+
+def buildAtlas(datadir,width=256,maxheight=1024,pad=1):
+    images = []
+    for f in sorted(os.listdir(datadir)):
+        name, ext = os.path.splitext(f)
+        if ext.lower() in (".bmp",".gif",".png") and not name.startswith("atlas"):
+            images.append( (name, pygame.image.load(os.path.join(datadir,f))) )
+    images.sort( key=lambda i: (-i[1].get_height(),-i[1].get_width(),i[0]) )
+    sheets, manifest = [[]], []
+    x = y = shelf = 0
+    for name,img in images:
+        w, h = img.get_size()
+        if x+w > width:
+            x, y, shelf = 0, y+shelf+pad, 0
+        if y+h > maxheight:
+            sheets.append([])
+            x = y = shelf = 0
+        sheets[-1].append( (name,img,x,y) )
+        x, shelf = x+w+pad, max(shelf,h)
+    for i,packed in enumerate(sheets):
+        sheetname = "atlas%d" % i
+        height = max( y+img.get_height() for name,img,x,y in packed )
+        sheet = pygame.Surface( (width,height), SRCALPHA, 32 )
+        sheet.fill( (0,0,0,0) )
+        for name,img,x,y in packed:
+            sheet.blit( img, (x,y), special_flags=BLEND_RGBA_ADD ) # plain copy onto the clear sheet
+            manifest.append( "%s %s %d %d %d %d\n" % ((name,sheetname,x,y)+img.get_size()) )
+        pygame.image.save( sheet, os.path.join(datadir,sheetname+".png") )
+    open( os.path.join(datadir,ATLASMANIFEST), "w" ).writelines( sorted(manifest) )
+    return len(sheets), len(manifest)
+
+# --------------------------------------------------------
+# Opt-in profiler: cumulative time and calls per behavior method,
+# per message type. enable() swaps timed wrappers into the classes
+# and disable() puts the originals back, so when it's off the game
+# runs its plain methods. Times are inclusive (turnTo is also in
+# its caller's update).
+# --------------------------------------------------------
+class Profiler:
+    def __init__(self):
+        self.stats = {}     # (class.method, msg id or None) -> [seconds, calls]
+        self.saved = []     # (class, name, original function)
+        self.enabled = False
+        self.overlay = False
+        self.lines, self.refresh = [], 0.0
+
+    def targets(self):
+        bhs = [ c for n,c in sorted(globals().items()) if n.startswith("Bh") and type(c) is type(Actor) ]
+        for c in bhs:
+            for n,f in sorted(c.__dict__.items()):
+                if callable(f) and not n.startswith("__"): yield c, n, n == "message"
+        yield Actor, "update", False
+        yield Actor, "sendMessage", True
+        yield MessageBus, "publish", True
+        yield GameClass, "collision", False
+        yield GameClass, "sweep", False
+
+    def wrap(self,label,f,bymsg):
+        stats, clock = self.stats, time.time
+        if bymsg:
+            def timed(obj,msg,*args,**kw):
+                t = clock()
+                try: return f(obj,msg,*args,**kw)
+                finally:
+                    s = stats.setdefault( (label,msg.id), [0.0,0] )
+                    s[0] += clock()-t
+                    s[1] += 1
+        else:
+            def timed(obj,*args,**kw):
+                t = clock()
+                try: return f(obj,*args,**kw)
+                finally:
+                    s = stats.setdefault( (label,None), [0.0,0] )
+                    s[0] += clock()-t
+                    s[1] += 1
+        return timed
+
+    def enable(self):
+        if self.enabled: return
+        for c,n,bymsg in self.targets():
+            f = c.__dict__[n]
+            self.saved.append( (c,n,f) )
+            setattr(c, n, self.wrap(c.__name__+"."+n, f, bymsg))
+        self.enabled = True
+
+    def disable(self):
+        for c,n,f in self.saved: setattr(c,n,f)
+        self.saved, self.enabled = [], False
+
+    # [(name, message type, seconds, calls)], most expensive first
+    def report(self):
+        names = dict( (v,k) for k,v in MSGTYPES.items() )
+        rows = [ (l, names.get(m,""), s[0], s[1]) for (l,m),s in self.stats.items() ]
+        return sorted( rows, key=lambda r: -r[2] )
+
+    def dump(self,path):
+        f = open(path,"w")
+        f.write("name,message,calls,total_ms,mean_us\n")
+        for l,m,t,n in self.report():
+            f.write("%s,%s,%d,%.3f,%.2f\n" % (l,m,n,t*1000.0,t*1e6/max(n,1)))
+        f.close()
+
+    # top rows as text, refreshed twice a second
+    def drawOverlay(self,dt,rows=12):
+        self.refresh -= dt
+        if self.refresh <= 0.0:
+            self.refresh = 0.5
+            txt = [ "%-32s %8.1fms %7d" % (l+("["+m+"]" if m else ""),t*1000.0,n) for l,m,t,n in self.report()[:rows] ]
+            self.lines = [ GAME.renderText("type_writer.ttf",10,t,(255,255,255),(0,0,0)) for t in txt ]
+        y = 4
+        for surf in self.lines:
+            GAME.draw( MAXZ, surf, surf.get_rect(topleft=(4,y)) )
+            y += surf.get_height()
+
+# --------------------------------------------------------
+# Actors created together and discarded together, like the blocks
+# of a level. While a group is open GameClass.addActor puts new
+# actors in it too.
+# --------------------------------------------------------
+class ActorGroup:
+    def __init__(self,name):
+        self.name = name
+        self.actors = []
+
+# --------------------------------------------------------
+# Main Game class. A headless game has no display, no drawing
+# thread and no sound: the world is only simulated.
 # --------------------------------------------------------
 class GameClass:
-    def __init__(self,name,resolution):
+    def __init__(self,name,resolution,textbudget=256*1024,imagebudget=8*1024*1024,rotstep=1,
+                 dirtyrects=False,maxdirty=0.5,fps=60,bake=True,headless=False,profile=None,prefetch=None,seed=None,
+                 vectorize=False):
         self.clock = pygame.time.Clock()
         self.SCREENRECT= Rect(0, 0, resolution[0], resolution[1])
-        self.IMAGECACHE, self.SOUNDCACHE, self.FONTCACHE = {}, {}, {}
+        self.SOUNDCACHE, self.FONTCACHE, self.LEVELCACHE = {}, {}, {}
+        self.IMAGECACHE = SurfaceCache(imagebudget) # rotated variants are evictable
+        self.TEXTCACHE = SurfaceCache(textbudget)
+        self.rotstep = rotstep # rotation granularity in degrees
+        if seed is None: seed = int(time.time()*1000) & 0xffffffff
+        self.seed = seed
+        self.rng = random.Random(seed) # every random decision of the game
+        self.ATLAS = loadManifest("data") # image name -> (sheet file, rect)
         self.KEYPRESSED = None
-        bestdepth = pygame.display.mode_ok(self.SCREENRECT.size, pygame.DOUBLEBUF, 32)
-        self.SCREEN = pygame.display.set_mode(self.SCREENRECT.size, pygame.DOUBLEBUF, bestdepth)
+        self.headless = headless
+        self.SCREEN = None
+        if not headless:
+            bestdepth = pygame.display.mode_ok(self.SCREENRECT.size, pygame.DOUBLEBUF, 32)
+            self.SCREEN = pygame.display.set_mode(self.SCREENRECT.size, pygame.DOUBLEBUF, bestdepth)
+            pygame.display.set_caption(name)
         self.name = name
-        pygame.display.set_caption(name)
         self.newactors = []
         self.actors = []
-        self.drawingbuff, self.commandbuff = [], []
-        self.atfps, self.nextSound = 0.0, 0.0
-        self.drawingThread = DrawingThread(self)
-        self.drawingThread.start()
-        self.levels, self.curlevel = os.listdir ( "data/levels" ), 0
+        self.group = None # open ActorGroup
+        self.drawingbuff, self.commandbuff = RenderQueue(), RenderQueue() # last published, being filled
+        self.exchange = FrameExchange()
+        self.colliders = CollisionIndex()
+        self.now, self.timers = 0.0, TimerWheel() # sim time, callbacks at sim times
+        self.movers = None # MoverSystem when vectorized
+        if vectorize:
+            if numpy: self.movers = MoverSystem()
+            else: print "Warning, numpy not available, movers not vectorized"
+        self.staticLayer = StaticLayer(self.SCREENRECT, maxz = 0 if bake and not headless else BACKZ)
+        self.bus = MessageBus()
+        self.animPool = EffectPool(newAnim, 32)
+        self.textPool = EffectPool(newTextAnim, 32)
+        self.atfps, self.nextkey = 0.0, 0.0
+        self.profiler, self.profile = Profiler(), profile # csv path written on destroy
+        if profile: self.profiler.enable()
+        self.drawingThread = None
+        if not headless:
+            self.drawingThread = DrawingThread(self,dirtyrects,maxdirty,fps)
+            self.drawingThread.start()
+        self.levels = sorted( l for l in os.listdir( "data/levels" ) if l.endswith(".lvl") )
         self.curlevel = len(self.levels)-1
+        self.prefetcher = None # by default only with a window
+        if prefetch or (prefetch is None and not headless):
+            self.prefetcher = LevelPrefetcher(self)
+            self.prefetcher.start()
         #preloading
-        self.loadSound("click")
-        self.loadSound("xp")
-        self.loadSound("bell")
+        self.voices = None
+        if not headless and pygame.mixer and pygame.mixer.get_init():
+            self.voices = VoiceManager()
+            for name in SOUNDS: self.loadSound(name)
         
     def nextLevel(self):
         return os.path.join("data/levels",self.levels[ self.curlevel%len(self.levels) ])
@@ -81,6 +1138,17 @@ class GameClass:
         else:
             font = self.FONTCACHE[ key ]
         return font
+
+    # rendered text, cached by (font, size, text, color, background)
+    def renderText(self,fontname,size,txt,color,bg=None):
+        key = (fontname,size,txt,color,bg)
+        surf = self.TEXTCACHE.get(key)
+        if surf is None:
+            font = self.loadFont(fontname,size)
+            if bg: surf = font.render(txt, 1, color, bg)
+            else:  surf = font.render(txt, 1, color)
+            self.TEXTCACHE.put(key,surf)
+        return surf
         
     def loadSound(self,name):
         fullname = "data/"+name #os.path.join('data', name)
@@ -97,120 +1165,354 @@ class GameClass:
         return sound
     
     def loadImage(self,file, rotation = 0, flipx = False, flipy = False):
+        rotation = int(round(rotation/float(self.rotstep)))*self.rotstep % 360
         key = (file, rotation, flipx, flipy)
-        if not self.IMAGECACHE.has_key(key):
-            path = "data/"+file #os.path.join('data', file)
-            ext = ["", ".bmp", ".gif", ".png"]
-            for e in ext:
-                if os.path.exists(path + e):
-                    path = path + e
-                    break
+        img = self.IMAGECACHE.get(key)
+        if img is None:
             if rotation or flipx or flipy:
                 img = self.loadImage(file)
+            elif self.ATLAS.has_key(file):
+                sheet, r = self.ATLAS[file]
+                img = self.loadImage(sheet).subsurface(r)
             else:
-                img = pygame.image.load(path).convert_alpha()
+                img = self.readImage(file)
             if rotation:
-                img = pygame.transform.rotate(img, rotation)
+                img = pygame.transform.rotozoom(img, rotation, 1.0)
             if flipx or flipy:
                 img = pygame.transform.flip(img, flipx, flipy)
-            self.IMAGECACHE[key] = img
-        return self.IMAGECACHE[key]
+            self.IMAGECACHE.put(key, img, pinned = not rotation)
+        return img
         
+    # compiled level, from memory, the .lvlc next to the source or
+    # compiling the source. Stale when the source mtime changes.
+    # A level prepared by the prefetcher is swapped in, with its images.
+    def loadLevel(self,path):
+        mtime = os.path.getmtime(path)
+        cached = self.LEVELCACHE.get(path)
+        if cached and cached[0] == mtime: return cached[1]
+        ready = self.prefetcher and self.prefetcher.take(path)
+        if ready and ready[0] == mtime:
+            lvl = ready[1]
+            for name,img in ready[2].items():
+                self.IMAGECACHE.put( (name,0,False,False), img, pinned=True )
+        else:
+            lvl = readLevel(path,mtime)
+        self.LEVELCACHE[path] = (mtime,lvl)
+        return lvl
+
+    # Runs on the prefetcher: reads the level and the images it's missing
+    # without touching the game caches, loadLevel merges them later.
+    def prepareLevel(self,path):
+        mtime = os.path.getmtime(path)
+        lvl = readLevel(path,mtime)
+        images = {}
+        for name in levelImages(lvl):
+            if not self.ATLAS.has_key(name) and not self.IMAGECACHE.pinned.has_key( (name,0,False,False) ):
+                images[name] = self.readImage(name)
+        return mtime, lvl, images
+
+    # F4/F5 neighbours of the current level, to have them ready
+    def prefetchLevels(self):
+        if not self.prefetcher: return
+        for d in (1,-1):
+            path = os.path.join("data/levels",self.levels[ (self.curlevel+d)%len(self.levels) ])
+            if not self.LEVELCACHE.has_key(path): self.prefetcher.request(path)
+
+    # image file by name, probing the extensions
+    def readImage(self,file):
+        path = "data/"+file #os.path.join('data', file)
+        ext = ["", ".bmp", ".gif", ".png"]
+        for e in ext:
+            if os.path.exists(path + e):
+                path = path + e
+                break
+        img = pygame.image.load(path)
+        if self.SCREEN: img = img.convert_alpha()
+        return img
+
     def playSound(self,name,vol=1.0):
-        if self.nextSound <= 0.0: # avoiding two very consecutive sounds
-            sound = self.loadSound(name)
-            sound.set_volume(vol)
-            sound.play()
-            self.nextSound = 0.1
+        if not self.voices: return
+        sound = self.loadSound(name)
+        if sound: self.voices.play(name,sound,vol,self.now)
         
     def destroy(self):
-        self.drawingThread.ended = True
-        self.drawingThread.join()
+        if self.drawingThread:
+            self.drawingThread.ended = True
+            self.drawingThread.join()
+        if self.prefetcher:
+            self.prefetcher.stop()
+        self.profiler.disable()
+        if self.profile: self.profiler.dump(self.profile)
+
+    # keys for this frame, F4/F5 cycle through levels, F3 toggles
+    # the profiler overlay (profiling starts the first time)
+    def input(self,keys,dt):
+        self.KEYPRESSED = keys
+        if (keys[K_F5] or keys[K_F4]) and self.nextkey <= 0.0:
+            self.curlevel += 1 if keys[K_F5] else -1
+            self.sendMessage( Message(MSG_STAGECLEAR) )
+            self.nextkey = .5
+        if keys[K_F3] and self.nextkey <= 0.0:
+            if not self.profiler.enabled:
+                self.profiler.enable()
+                self.relinkActors()
+            self.profiler.overlay = not self.profiler.overlay
+            self.nextkey = .5
+        self.nextkey -= dt
         
     def sendMessage(self,msg):
-        for a in self.actors:
-            a.sendMessage(msg)
-        for a in self.newactors:
-            a.sendMessage(msg)
+        self.bus.publish(msg)
+
+    def postMessage(self,msg):
+        self.bus.post(msg)
+
+    def subscribe(self,b,*types):
+        self.bus.subscribe(b,types)
             
+    # dispatch tables hold bound methods: rebuilt when the classes'
+    # methods change (profiling on)
+    def relinkActors(self):
+        for a in self.actors + self.newactors + self.animPool.free + self.textPool.free:
+            if not a.iterating: a.relink()
+
     def addActor(self,a):
         self.newactors.append(a)
+        if self.group: self.group.actors.append(a)
+
+    def openGroup(self,name):
+        self.group = ActorGroup(name)
+        return self.group
+
+    def closeGroup(self):
+        self.group = None
+
+    # Drops a whole group in one step: out of the actor lists, the bus,
+    # the collision index, the static layer and the frames not drawn yet.
+    # Their behaviors are released too and their timers cancelled, which
+    # breaks the actor/behavior cycles: the memory goes back by refcount
+    # once nothing else holds the actors, not at the next gc. Called from
+    # an update, the pass going on still holds them until it ends, so a
+    # new level is built after it (see BhLevel).
+    def discardGroup(self,g):
+        gone = set(g.actors)
+        for a in g.actors: a.terminated = True
+        self.actors = [a for a in self.actors if a not in gone]
+        self.newactors = [a for a in self.newactors if a not in gone]
+        self.bus.unsubscribeActors(gone)
+        self.colliders.removeAll(gone)
+        self.staticLayer.dropAll(gone)
+        self.commandbuff.discard( gone )
+        self.exchange.purge()
+        for a in g.actors:
+            for b in a.behaviors + a.added: b.cancelTimer()
+            a.behaviors, a.added, a.updaters, a.handlers = [], [], [], []
+        g.actors = []
+        if self.movers: self.movers.stale = True
         
-    def draw(self,cmd):
-        self.commandbuff.append(cmd)       
+    def draw(self,z,surf,rect,key=None):
+        self.commandbuff.add(z,surf,rect,key)
     
+    # crc32 of the simulated state: level, positions, player stats
+    def checksum(self):
+        vals = [ self.curlevel, len(self.actors) ]
+        for a in self.actors:
+            vals.append( a.x )
+            vals.append( a.y )
+            if a.points is not None: vals += [ a.points, a.bounces ]
+        return zlib.crc32( struct.pack("<%dd" % len(vals), *vals) ) & 0xffffffff
+
     # return minimum collision object
     def collision(self,o,r):
-        minor = 1e10
-        collider = None
-        for a in self.actors:
-            if hasattr(a,"collidable") and a.collidable:
-                if r.colliderect( a.rect ):
-                    d = (o[0] - a.rect.centerx)*(o[0]-a.rect.centerx) + \
-                        (o[1] - a.rect.centery)*(o[1]-a.rect.centery)
-                    if d < minor:
-                        minor = d
-                        collider = a
-        return collider
+        return self.colliders.query(o,r)
+
+    # first collision moving a box, see CollisionIndex.sweep
+    def sweep(self,x,y,w,h,dx,dy):
+        return self.colliders.sweep(x,y,w,h,dx,dy)
                 
     def update(self,dt):
         # Update fps stats
         self.atfps += dt
-        self.nextSound -= dt
-        if self.atfps > 3.0:
+        if self.atfps > 3.0 and not self.headless:
             pygame.display.set_caption(self.name + " fps: " + str(int(self.clock.get_fps())) + \
-                                " / " + str(int(self.drawingThread.clock.get_fps())))
+                                " / " + str(int(self.drawingThread.clock.get_fps())) + \
+                                " q: " + str(self.bus.peak) + " c: " + str(self.bus.coalesced) + \
+                                ( " v: %d/%d/%d" % tuple(self.voices.totals()) if self.voices else "" ))
             self.atfps = 0.0
+            self.bus.peak, self.bus.coalesced = 0, 0
         
-        # Processing actors, and we remove those terminated
+        self.updateActors(dt)
+        if self.profiler.overlay and self.SCREEN:
+            self.profiler.drawOverlay(dt)
+
+        self.commandbuff.background = self.staticLayer.flush()
+
+        # Publishing the new rendering commands (already in z order) to the
+        # rendering thread, the next ones go in a frame it's done with
+        self.drawingbuff = self.commandbuff
+        self.commandbuff = self.exchange.publish( self.drawingbuff )
+
+    def updateActors(self,dt):
+        self.now += dt
+        if self.movers and self.movers.stale: self.movers.rebuild() # lets go of discarded ones before timers run
+        self.timers.advance(self.now)
+        if self.movers: self.movers.update(dt)
+
+        # Processing actors, terminated ones are skipped and compacted
+        # out afterwards in a single pass (keeps the order)
+        dead = False
         for a in self.actors:
             if a.terminated:
-                self.actors.remove(a)
+                dead = True
             else:
                 a.update(dt)
+                self.colliders.sync(a)
+
+        # Deferred messages go out here, once per frame
+        self.bus.drain()
+
+        if dead:
+            alive = []
+            for a in self.actors:
+                if a.terminated:
+                    self.colliders.remove(a)
+                    self.staticLayer.drop(a)
+                    if a.pool: a.pool.release(a)
+                else: alive.append(a)
+            self.actors = alive
+            if self.movers: self.movers.stale = True
         
         # Adding new actors from incoming actors buffer
         if len(self.newactors)>0:
+            for a in self.newactors:
+                if a.collidable is not None: self.colliders.add(a)
             self.actors += self.newactors
             self.newactors = []
-        
-        # Swapping buffers and notifying to rendering thread the new rendering commands
-        self.drawingbuff, self.commandbuff = self.commandbuff, self.drawingbuff        
-        self.drawingbuff.sort()
-        self.drawingThread.flip( self.drawingbuff )
-        self.commandbuff = []        
+            if self.movers: self.movers.promote()
 
 # --------------------------------------------------------
-# Main Entity class (contains behaviors)
+# Main Entity class (contains behaviors). Every component an
+# actor may get from its behaviors is declared here with its
+# default, so no actor carries an attribute dict.
 # --------------------------------------------------------
-class Actor:    
+class Actor(object):
+    __slots__ = ("terminated","behaviors","added","iterating","stale","pool","updaters","handlers",
+                 "x","y","zord","rect","image","imageName","visible",    # BhDrawing
+                 "collidable","response",                                # BhColliding
+                 "blinking",                                             # BhBlinking
+                 "points","bounces",                                     # BhPlayerStatus
+                 "drawing","effect",                                     # pooled effects
+                 "__weakref__")                                          # for checks of discarded levels
     def __init__(self):
         self.terminated = False
         self.behaviors = []
-        
+        self.added = []     # behaviors added while iterating
+        self.iterating = 0
+        self.stale = False  # a behavior ended while iterating, relink after
+        self.pool = None    # EffectPool owning this actor, if any
+        self.updaters, self.handlers = [], [] # bound update / message of live behaviors
+        self.x, self.y, self.zord = 0, 0, 0
+        self.rect, self.image, self.imageName = None, None, ""
+        self.visible = True
+        self.collidable = None # None: never collides, not indexed
+        self.response = True
+        self.blinking = False
+        self.points, self.bounces = None, 0 # None: not a player
+        self.drawing, self.effect = None, None
+
+    # newest behavior goes first. While the lists are being walked new ones
+    # wait in self.added, so every pass sees a stable list.
     def addBehavior(self,beh):
-        self.behaviors.insert( 0, beh )
-        
+        if self.iterating: self.added.append( beh )
+        else:
+            self.behaviors.insert( 0, beh )
+            self.relink()
+
+    def endIteration(self):
+        self.iterating -= 1
+        if self.iterating == 0 and (self.added or self.stale):
+            self.added.reverse()
+            self.behaviors[0:0] = self.added
+            self.added = []
+            self.relink()
+
+    # rebuilds the dispatch tables, dropping terminated behaviors
+    def relink(self):
+        self.stale = False
+        self.behaviors = [b for b in self.behaviors if not b.terminated]
+        self.updaters = [b.update for b in self.behaviors if b.update is not None]
+        self.handlers = [b.message for b in self.behaviors if b.message is not None]
+
+    # a behavior terminated. A pass walking the tables skips it from
+    # now on (its entries become nop in place), then it's unlinked.
+    def unlink(self,b):
+        for fs,f in ((self.updaters,b.update),(self.handlers,b.message)):
+            if f is not None:
+                for i in xrange(len(fs)):
+                    if fs[i] == f: fs[i] = nop
+        if self.iterating: self.stale = True
+        else: self.relink()
+
     def sendMessage(self,msg):
-        for b in self.behaviors:
-            t = hasattr(b,"terminated") and b.terminated
-            if hasattr(b,"message") and not t:
-                b.message(msg)
-            
+        self.iterating += 1
+        for f in self.handlers: f(msg)
+        self.endIteration()
+
     def update(self,dt):
-        for b in self.behaviors:            
-            if hasattr(b,"terminated") and b.terminated:
-                self.behaviors.remove( b )
-            elif hasattr(b,"update"): 
-                b.update(dt)
+        self.iterating += 1
+        for f in self.updaters: f(dt)
+        self.endIteration()
+
+# --------------------------------------------------------
+# Base of every behavior. Subclasses declare their own fields in
+# __slots__ and leave update / message as None when they don't
+# handle them. A behavior ends with terminate(), which takes it
+# out of its actor's dispatch tables. Countdowns are timers:
+# after(delay,fn) calls fn once delay seconds of sim time have
+# passed, unless the behavior or its actor is gone by then.
+# --------------------------------------------------------
+class Behavior(object):
+    __slots__ = ("actor","terminated","timer")
+    update = None
+    message = None
+    def __init__(self,actor):
+        self.actor = actor
+        self.terminated = False
+        self.timer = None
+
+    def terminate(self):
+        if not self.terminated:
+            self.terminated = True
+            self.cancelTimer()
+            self.actor.unlink(self)
+
+    # one pending timer per behavior, a new one replaces it
+    def after(self,delay,fn):
+        self.cancelTimer()
+        self.timer = GAME.timers.schedule( GAME.now+delay, self.wake, fn )
+
+    def cancelTimer(self):
+        if self.timer:
+            GAME.timers.cancel(self.timer)
+            self.timer = None
+
+    def wake(self,fn):
+        self.timer = None
+        if not self.actor.terminated: fn()
+
+def nop(arg):
+    pass
 
 # --------------------------------------------------------
 # Draw a sprite. Actor acts like a sprite then.
 # --------------------------------------------------------
-class BhDrawing:
+class BhDrawing(Behavior):
+    __slots__ = ()
     def __init__(self,actor,img=None,pos=(),zord=0):
-        self.actor = actor
+        Behavior.__init__(self,actor)
         self.actor.zord = zord
+        self.reset(img,pos)
+
+    def reset(self,img=None,pos=()):
         self.actor.visible = True
         self.actor.image = None
         self.actor.rect = None
@@ -227,112 +1529,120 @@ class BhDrawing:
     def update(self,dt):
         if self.actor.image != None and self.actor.visible:
             self.actor.rect.topleft = (self.actor.x, self.actor.y)
-            GAME.draw( ( self.actor.zord, self.actor.image, self.actor.rect ) )
+            if not GAME.staticLayer.keep(self.actor):
+                GAME.draw( self.actor.zord, self.actor.image, self.actor.rect, self.actor )
+        else:
+            GAME.staticLayer.drop(self.actor)
 
 # --------------------------------------------------------
 # 
 # --------------------------------------------------------
-class BhBrokenBlock:
+class BhBrokenBlock(Behavior):
+    __slots__ = ()
     def __init__(self,actor):
-        self.actor = actor
+        Behavior.__init__(self,actor)
         self.actor.image = GAME.loadImage("bblock")
         self.actor.rect = self.actor.image.get_rect()
         
     def message(self,msg):
-        if msg["msg"] == "collision":            
-            vx,vy = msg["vec"]
+        if msg.id == MSG_COLLISION:
+            vx,vy = msg.vec
             #if vx*vx + vy*vy > 750*750:
             self.actor.terminated = True
-            GAME.sendMessage({"msg":"updatepoints","points":1})
+            GAME.postMessage( Message(MSG_UPDATEPOINTS,value=1) )
 
 # --------------------------------------------------------
 # With this behav., the entity can collide 
 # --------------------------------------------------------
-class BhColliding:
+class BhColliding(Behavior):
+    __slots__ = ()
     def __init__(self,actor,response=True):
-        self.actor = actor
+        Behavior.__init__(self,actor)
         self.actor.collidable = True
         self.actor.response = True
 
 # --------------------------------------------------------
 # 
 # --------------------------------------------------------
-class BhTurningBlock:
+class BhTurningBlock(Behavior):
+    __slots__ = ("step","ang","nextcoll","acumang","pow","savedimg","oldcenter")
     def __init__(self,actor,step=2,ang=90,defang=0,pow=500):
-        self.actor = actor        
+        Behavior.__init__(self,actor)
         self.actor.response = False
         self.step, self.ang = step, ang
-        self.nextTurn = step
-        self.nextcoll = 0
+        self.nextcoll = GAME.now # sim time it blasts again
         self.acumang = 0
         self.pow = pow
-        self.savedimg = self.actor.image        
+        self.savedimg = self.actor.imageName
+        self.oldcenter = None
         if defang:
             self.acumang = defang
             self.turnTo(defang)
+        self.after(step,self.turn)
         
-    def update(self,dt):
-        self.nextcoll -= dt
-        self.nextTurn -= dt
-        if self.nextTurn <= 0.0:            
-            self.acumang += self.ang
-            self.nextTurn = self.step
-            self.turnTo(self.acumang)
+    def turn(self):
+        self.acumang += self.ang
+        self.turnTo(self.acumang)
+        self.after(self.step,self.turn)
             
     def turnTo(self,ang):
         self.oldcenter = (self.actor.x+self.actor.rect.width/2, self.actor.y+self.actor.rect.height/2)
-        self.actor.image = pygame.transform.rotozoom( self.savedimg, self.acumang, 1.0 )
+        self.actor.image = GAME.loadImage( self.savedimg, rotation=self.acumang )
         self.actor.rect = self.actor.image.get_rect()
         self.actor.x = self.oldcenter[0]-self.actor.rect.width/2
         self.actor.y = self.oldcenter[1]-self.actor.rect.height/2            
+        self.actor.rect.topleft = (self.actor.x, self.actor.y) # turns run off the timers, before
+        GAME.colliders.sync(self.actor)                        # the actor pass may query it
             
     def message(self,msg):
-        if msg["msg"] == "collision" and self.nextcoll < 0.0:
-            self.nextcoll = 0.2
+        if msg.id == MSG_COLLISION and GAME.now > self.nextcoll:
+            self.nextcoll = GAME.now+0.2
             r = math.radians(self.acumang)
             c = self.actor.rect.center
-            GAME.sendMessage( {"msg":"blastplayer","vec":( -math.sin(r),-math.cos(r)),
-                               "pw":self.pow,"o":c} )
+            GAME.sendMessage( Message(MSG_BLASTPLAYER,vec=( -math.sin(r),-math.cos(r)),
+                                      value=self.pow,org=c) )
             
             
 # --------------------------------------------------------
 # 
 # --------------------------------------------------------
-class BhSleepingBlock:
+class BhSleepingBlock(Behavior):
+    __slots__ = ()
     def __init__(self,actor):
-        self.actor = actor
-        self.next = 0.0
+        Behavior.__init__(self,actor)
         self.actor.zord = 7
+        self.after(0.0,self.snore)
         
     def message(self,msg):
-        if msg["msg"] == "collision":
-            self.terminated = True
+        if msg.id == MSG_COLLISION:
+            self.terminate()
             self.actor.addBehavior( BhDeathBlock(self.actor,bt=0.5) )
-            self.actor.addBehavior( BhChasingBlock(self.actor, msg["player"]) )
+            self.actor.addBehavior( BhChasingBlock(self.actor, msg.player) )
             self.actor.image = GAME.loadImage("pblock2")
             
-    def update(self,dt):
-        self.next -= dt
-        if self.next <= 0.0:
-            createTextAnim( "z", self.actor.x+self.actor.rect.width/2,\
-                                 self.actor.y+self.actor.rect.height/2, 1.5, (0,0,255) )
-            self.next = 3.0
+    def snore(self):
+        createTextAnim( "z", self.actor.x+self.actor.rect.width/2,\
+                             self.actor.y+self.actor.rect.height/2, 1.5, (0,0,255) )
+        self.after(3.0,self.snore)
 
 # --------------------------------------------------------
 # Chasing
 # --------------------------------------------------------
-class BhChasingBlock:
+class BhChasingBlock(Behavior):
+    __slots__ = ("player","waitTime","chaseTime","vel","n","state","chaseVec")
     def __init__(self,actor,player,wt=2.0,ct=2.0,n=-1,vel=38):
-        self.actor = actor
+        Behavior.__init__(self,actor)
         self.player = player
         self.waitTime, self.chaseTime = wt, ct
         self.vel = vel
         self.n = n+1
+        self.chaseVec = (0.0,0.0)
         self.changeState( "wait" )
+        GAME.subscribe( self, MSG_PLAYERDIE )
         
     def changeState(self,st):
         self.state = st
-        self.nextState = self.waitTime if st == "wait" else self.chaseTime
+        self.after( self.waitTime if st == "wait" else self.chaseTime, self.switchState )
         if st == "chase":
             v = (self.player.x-self.actor.x,self.player.y-self.actor.y)
             l = math.sqrt(v[0]*v[0] + v[1]*v[1])
@@ -343,45 +1653,48 @@ class BhChasingBlock:
             self.n -= 1            
             
     def backToSleep(self):
-        self.terminated = True
-        self.actor.sendMessage( {"msg":"nodeath"} )
+        self.terminate()
+        self.actor.sendMessage( Message(MSG_NODEATH) )
         self.actor.addBehavior( BhSleepingBlock(self.actor) )
         self.actor.image = GAME.loadImage("pblock")
         self.actor.rect = self.actor.image.get_rect()
+        self.actor.rect.topleft = (self.actor.x, self.actor.y)
+        GAME.colliders.sync(self.actor)
         
+    def switchState(self):
+        self.changeState( "wait" if self.state=="chase" else "chase" )
+
     def update(self,dt):
-        self.nextState -= dt
-        if self.nextState <= 0.0:
-            self.changeState( "wait" if self.state=="chase" else "chase" )
-        else:
-            if self.state == "chase":
-                self.actor.x += self.chaseVec[0]*self.vel*dt
-                self.actor.y += self.chaseVec[1]*self.vel*dt
+        if self.state == "chase":
+            self.actor.x += self.chaseVec[0]*self.vel*dt
+            self.actor.y += self.chaseVec[1]*self.vel*dt
     
     def message(self,msg):
-        if msg["msg"] == "playerdie":
+        if msg.id == MSG_PLAYERDIE:
             self.backToSleep()
             
 # --------------------------------------------------------
 # Acts like a white block
 # --------------------------------------------------------
-class BhWhiteBlock:
+class BhWhiteBlock(Behavior):
+    __slots__ = ()
     def __init__(self,actor):
-        self.actor = actor
+        Behavior.__init__(self,actor)
     def message( self, msg ):
-        if msg["msg"] == "collision":
-            self.terminated = True
-            self.actor.sendMessage( {"msg":"turn2yellow"} )
-            GAME.sendMessage({"msg":"updatepoints","points":1})
-            GAME.sendMessage({"msg":"updateremains","remains":-1})
+        if msg.id == MSG_COLLISION:
+            self.terminate()
+            self.actor.sendMessage( Message(MSG_TURN2YELLOW) )
+            GAME.postMessage( Message(MSG_UPDATEPOINTS,value=1) )
+            GAME.postMessage( Message(MSG_UPDATEREMAINS,value=-1) )
             self.actor.addBehavior( BhYellowBlock(self.actor) )
 
 # --------------------------------------------------------
 # Acts like a enemy block
 # --------------------------------------------------------
-class BhDeathBlock:
+class BhDeathBlock(Behavior):
+    __slots__ = ()
     def __init__(self,actor,blink=True,bt=1.0):
-        self.actor = actor        
+        Behavior.__init__(self,actor)
         if blink:
             self.actor.addBehavior( BhBlinking(actor,bt) )
         else:
@@ -389,37 +1702,39 @@ class BhDeathBlock:
         
     def message(self,msg):
         if not self.actor.blinking:
-            if msg["msg"] == "collision":
-                GAME.sendMessage( { "msg": "playerdie" } )
-            elif msg["msg"] == "nodeath":
-                self.terminated = True
+            if msg.id == MSG_COLLISION:
+                GAME.sendMessage( Message(MSG_PLAYERDIE) )
+            elif msg.id == MSG_NODEATH:
+                self.terminate()
 
 # --------------------------------------------------------
 # Acts like a yellow block
 # --------------------------------------------------------
-class BhYellowBlock:
+class BhYellowBlock(Behavior):
+    __slots__ = ()
     def __init__(self,actor,blink=True):
-        self.actor = actor
+        Behavior.__init__(self,actor)
         if blink:
             self.actor.addBehavior( BhBlinking(actor,0.8,0.04) )
         else:
             self.actor.blinking = False
         
     def message( self, msg ):
-        if not self.actor.blinking and msg["msg"] == "collision":
-            self.terminated = True
+        if not self.actor.blinking and msg.id == MSG_COLLISION:
+            self.terminate()
             self.actor.image = GAME.loadImage("rblock")
-            self.actor.sendMessage( {"msg":"turn2death"} )
-            GAME.sendMessage( {"msg":"updatepoints","points":-1} )
+            self.actor.sendMessage( Message(MSG_TURN2DEATH) )
+            GAME.postMessage( Message(MSG_UPDATEPOINTS,value=-1) )
             self.actor.addBehavior( BhShaking(self.actor) )
             self.actor.addBehavior( BhDeathBlock(self.actor) )
 
 # --------------------------------------------------------
 # Blink behavior in a time
 # --------------------------------------------------------
-class BhBlinking:
+class BhBlinking(Behavior):
+    __slots__ = ("enabledtime","v","at")
     def __init__(self,actor,et=1.0,v=0.04):
-        self.actor = actor
+        Behavior.__init__(self,actor)
         self.enabledtime = et
         self.v = v
         self.at = v
@@ -433,14 +1748,15 @@ class BhBlinking:
         if self.enabledtime <= 0.0:
             self.actor.visible = True
             self.actor.blinking = False
-            self.terminated = True
+            self.terminate()
 
 # --------------------------------------------------------
 # Moves the block
 # --------------------------------------------------------
-class BhMoverBlock:
+class BhMoverBlock(Behavior):
+    __slots__ = ("at","dirx","diry","savedx","savedy","vel","dist")
     def __init__(self,actor,vel=2.0,dist=64.0,dirx=1.0,diry=0.0):
-        self.actor = actor
+        Behavior.__init__(self,actor)
         self.at = 0.0
         self.dirx,self.diry = dirx,diry
         self.savedx,self.savedy = self.actor.x,self.actor.y
@@ -450,50 +1766,144 @@ class BhMoverBlock:
         self.actor.x = self.savedx + math.sin(self.at) * self.dist * self.dirx
         self.actor.y = self.savedy + math.cos(self.at) * self.dist * self.diry
         self.at += dt*self.vel
+
+# --------------------------------------------------------
+# BhMoverBlock for many blocks at once: the parameters of every
+# mover live in numpy arrays and one pass per frame, before the
+# actors update, computes all the positions (same operations in
+# the same order, so the same floats) and writes them to the
+# actors. A VecMover holds a mover's parameters between rebuilds
+# and has no update, unless a newer behavior of its actor updates
+# too (a shake): that one could move the block first, so the
+# position is written again where BhMoverBlock would move it.
+# --------------------------------------------------------
+class VecMover(Behavior):
+    __slots__ = ("system","i","at","dirx","diry","savedx","savedy","vel","dist")
+    def __init__(self,actor,system,vel=2.0,dist=64.0,dirx=1.0,diry=0.0):
+        Behavior.__init__(self,actor)
+        self.system = system
+        self.i = None
+        self.at = 0.0
+        self.dirx,self.diry = dirx,diry
+        self.savedx,self.savedy = self.actor.x,self.actor.y
+        self.vel, self.dist = vel, dist
+        self.actor.zord = 8
+
+    # read by Actor.relink
+    @property
+    def update(self):
+        bs = self.actor.behaviors
+        for b in bs[:bs.index(self)]:
+            if b.update is not None: return self.rewrite
+        return None
+
+    def rewrite(self,dt):
+        s = self.system
+        self.actor.x, self.actor.y = s.xs[self.i], s.ys[self.i]
+
+class MoverSystem:
+    FIELDS = ("at","savedx","savedy","dirx","diry","vel","dist")
+    def __init__(self):
+        self.movers, self.added, self.ready = [], [], []
+        self.actors = [] # of movers, same order
+        self.stale = False
+
+    def add(self,actor,*args,**kw):
+        m = VecMover(actor,self,*args,**kw)
+        self.added.append(m)
+        return m
+
+    # movers start moving with their actors: next frame after these
+    # join GAME.actors
+    def promote(self):
+        self.ready += self.added
+        self.added = []
+
+    # new movers join and dead ones leave, at the start of a frame
+    def rebuild(self):
+        if self.movers:
+            for m,at in zip(self.movers,self.at.tolist()): m.at = at
+        self.movers = [ m for m in self.movers + self.ready if not m.actor.terminated ]
+        self.actors = [ m.actor for m in self.movers ]
+        self.added = [ m for m in self.added if not m.actor.terminated ]
+        self.ready, self.stale = [], False
+        for i in xrange(len(self.movers)): self.movers[i].i = i
+        for f in self.FIELDS:
+            setattr( self, f, numpy.array([getattr(m,f) for m in self.movers], dtype=numpy.float64) )
+
+    def update(self,dt):
+        if self.ready or self.stale: self.rebuild()
+        if not self.movers: return
+        self.xs = xs = ( self.savedx + numpy.sin(self.at)*self.dist*self.dirx ).tolist()
+        self.ys = ys = ( self.savedy + numpy.cos(self.at)*self.dist*self.diry ).tolist()
+        for a,x,y in zip(self.actors,xs,ys):
+            a.x = x
+            a.y = y
+        self.at += dt*self.vel
+
+# BhMoverBlock, or a record in GAME.movers when they're vectorized
+def newMover(actor,*args,**kw):
+    if GAME.movers: return GAME.movers.add(actor,*args,**kw)
+    return BhMoverBlock(actor,*args,**kw)
         
 # --------------------------------------------------------
-# Shakes the block
+# Shakes the block now and then. Waiting is a timer, each shake
+# is a BhShake of its own for half a second.
 # --------------------------------------------------------
-class BhShaking:
+class BhShaking(Behavior):
+    __slots__ = ("nextshake","dir")
     def __init__(self,actor):
-        self.actor = actor
-        self.nextshake = random.randint(5,30)
+        Behavior.__init__(self,actor)
+        self.nextshake = GAME.rng.randint(5,30)
+        self.dir = GAME.rng.randint(0,1)
+        self.after(self.nextshake,self.shake)
+
+    def shake(self):
+        self.nextshake = GAME.rng.randint(15,30)
+        self.actor.addBehavior( BhShake(self.actor,self) )
+
+    # the shake is over, waits for the next one
+    def rest(self):
+        self.dir = GAME.rng.randint(0,1)
+        self.after(self.nextshake,self.shake)
+
+class BhShake(Behavior):
+    __slots__ = ("owner","at","saved")
+    def __init__(self,actor,owner):
+        Behavior.__init__(self,actor)
+        self.owner = owner
         self.at = 0.0
-        self.st = "waiting"
-        self.dir = random.randint(0,1)
-        
-    def update(self,dt):   
-        if self.st == "waiting":
-            self.nextshake -= dt
-            if self.nextshake <= 0.0:
-                self.nextshake = random.randint(15,30)
-                self.st = "shaking"
-                self.saved = self.actor.x if self.dir == 0 else self.actor.y
-        else:
-            self.at += dt
-            d = self.saved + math.sin(self.at*64.0)*4.0
-            if self.dir == 0: self.actor.x = d
-            else: self.actor.y = d
-            if self.at > 0.5:
-                self.st = "waiting"
-                self.at = 0.0
-                if self.dir == 0: self.actor.x = self.saved
-                else: self.actor.y = self.saved
-                self.dir = random.randint(0,1)
+        self.saved = self.actor.x if owner.dir == 0 else self.actor.y
+
+    def update(self,dt):
+        self.at += dt
+        d = self.saved + math.sin(self.at*64.0)*4.0
+        if self.owner.dir == 0: self.actor.x = d
+        else: self.actor.y = d
+        if self.at > 0.5:
+            if self.owner.dir == 0: self.actor.x = self.saved
+            else: self.actor.y = self.saved
+            self.terminate()
+            self.owner.rest()
                 
 # --------------------------------------------------------
 # Creates a points (+1, -1, -5 ...) animated sprite
 # --------------------------------------------------------
-class BhTextAnim:
-    def __init__(self,actor,points,pos,dur=0.8,c=(255,255,255)):
-        self.actor = actor
-        self.font = GAME.loadFont("type_writer.ttf",10)
+class BhTextAnim(Behavior):
+    __slots__ = ("time",)
+    def __init__(self,actor,points=None,pos=(),dur=0.8,c=(255,255,255)):
+        Behavior.__init__(self,actor)
+        self.time = 0.0
+        if points != None:
+            self.start(points,pos,dur,c)
+
+    def start(self,points,pos,dur=0.8,c=(255,255,255)):
         txt,color = str(points), c
         if type(points) is int:
             if points<0 : color = (255,0,0)
             else        : txt, color = "+"+txt, (0,255,0)
                 
-        self.actor.image = self.font.render(txt,1,color)
+        self.actor.image = GAME.renderText("type_writer.ttf",10,txt,color)
         self.actor.rect = self.actor.image.get_rect()
         self.actor.x, self.actor.y = pos[0]-self.actor.rect.width/2, pos[1]-self.actor.rect.height/2
         self.time = dur
@@ -508,9 +1918,16 @@ class BhTextAnim:
 # --------------------------------------------------------
 # Generic sprite animation (bounce and explosion)
 # --------------------------------------------------------
-class BhAnim:
-    def __init__(self,actor,anim,n=6,period=0.01):
-        self.actor = actor
+class BhAnim(Behavior):
+    __slots__ = ("n","period","images","nextimg","curimg")
+    def __init__(self,actor,anim=None,n=6,period=0.01):
+        Behavior.__init__(self,actor)
+        self.n, self.period, self.images = 0, period, []
+        self.nextimg, self.curimg = 0.0, 0
+        if anim != None:
+            self.start(anim,n,period)
+
+    def start(self,anim,n=6,period=0.01):
         self.n = n
         self.period = period
         self.images = [GAME.loadImage(i) for i in [anim+str(j) for j in range(0,n)]]
@@ -538,115 +1955,127 @@ class BhAnim:
 # --------------------------------------------------------
 # Changes the sprite every x seconds (gestures in blocks)
 # --------------------------------------------------------
-class BhGestureBlock:
+class BhGestureBlock(Behavior):
+    __slots__ = ("rt","at","images","state")
     def __init__(self,actor,img0,img1,rt=(10,25),at=2.0):
-        self.actor = actor
+        Behavior.__init__(self,actor)
         self.rt,self.at = rt,at
         self.images = [ GAME.loadImage(img0), GAME.loadImage(img1) ]
         self.actor.image = self.images[0]
         self.state = "norm"
-        self.nextimg = random.randint(rt[0],rt[1])
+        self.after( GAME.rng.randint(rt[0],rt[1]), self.gesture )
     
     def message(self,msg):
-        if msg["msg"] == "turn2yellow":
+        if msg.id == MSG_TURN2YELLOW:
             self.images = [ GAME.loadImage("yblock"), GAME.loadImage("yblock2") ]
             self.actor.image = self.images[0]
-        elif msg["msg"] == "turn2death":
-            self.terminated = True                        
+        elif msg.id == MSG_TURN2DEATH:
+            self.terminate()
     
-    def update(self,dt):        
-        self.nextimg -= dt
-        if self.nextimg <= 0.0:            
-            if self.state == "norm": 
-                self.state = "gest"
-                self.nextimg = random.random()*self.at
-                self.actor.image = self.images[1]
-            else:
-                self.state = "norm"
-                self.nextimg = random.randint(self.rt[0],self.rt[1])
-                self.actor.image = self.images[0]
+    def gesture(self):
+        if self.state == "norm": 
+            self.state = "gest"
+            self.after( GAME.rng.random()*self.at, self.gesture )
+            self.actor.image = self.images[1]
+        else:
+            self.state = "norm"
+            self.after( GAME.rng.randint(self.rt[0],self.rt[1]), self.gesture )
+            self.actor.image = self.images[0]
         
 # --------------------------------------------------------
 # --------------------------------------------------------
-class BhAlternateDeath:
+class BhAlternateDeath(Behavior):
+    __slots__ = ("images","t0","t1","state")
     def __init__(self,actor,img0,img1,t0=1,t1=1,alt=0):
-        self.actor = actor
+        Behavior.__init__(self,actor)
         self.images = [ GAME.loadImage(img0), GAME.loadImage(img1) ]
         self.t0,self.t1 = t0,t1
         self.changeState( "good" if alt==0 else "evil" )        
         
     def changeState(self,st):
         self.state = st
-        self.at = self.t0 if st == "good" else self.t1
+        self.after( self.t0 if st == "good" else self.t1, self.switchState )
         self.actor.image = self.images[ 0 if st=="good" else 1 ]
         self.actor.collidable = st == "evil"
             
-    def update(self,dt):
-        self.at -= dt
-        if self.at <= 0.0:
-            self.changeState("evil" if self.state == "good" else "good")
+    def switchState(self):
+        self.changeState("evil" if self.state == "good" else "good")
         
 # --------------------------------------------------------
 # Transform player in the avatar. Collision and key responses code
 # --------------------------------------------------------
-class BhPlayer:
+class BhPlayer(Behavior):
+    __slots__ = ("images","vx","vy","gtime","blasting")
     def __init__(self,actor):
-        self.actor = actor
+        Behavior.__init__(self,actor)
         self.images = [ GAME.loadImage(self.actor.imageName,flipx=True), GAME.loadImage(self.actor.imageName)]
         self.actor.rect.midbottom = (GAME.SCREENRECT.centerx, GAME.SCREENRECT.bottom)
         self.actor.x, self.actor.y = self.actor.rect.left, self.actor.rect.top
         self.vx,self.vy = 0.0,0.0
         self.gtime,self.blasting = 0.0, 0.0
+        GAME.subscribe( self, MSG_PLAYERDIE, MSG_LASTBLOCK, MSG_STAGECLEAR, MSG_BLASTPLAYER )
     
     def message(self,msg):
-        if msg["msg"] == "playerdie":
-            self.terminated = True
+        if msg.id == MSG_PLAYERDIE:
+            self.terminate()
             createAnim( self.actor.x+self.actor.rect.width/2, \
                         self.actor.y+self.actor.rect.height/2, "x", period=0.02 )
             GAME.playSound( "xp", 0.1 )
-            self.actor.addBehavior( BhPlayerPause(self.actor,"Press Space",color=(255,0,255),msg="playerspawn") )
-        elif msg["msg"] == "lastblock":
+            self.actor.addBehavior( BhPlayerPause(self.actor,"Press Space",color=(255,0,255),msg=MSG_PLAYERSPAWN) )
+        elif msg.id == MSG_LASTBLOCK:
             GAME.playSound( "bell", 0.1 )
-            self.terminated = True
-            self.actor.addBehavior( BhPlayerPause(self.actor,"Stage Clear!",(0,255,0),"stageclear") )
+            self.terminate()
+            self.actor.addBehavior( BhPlayerPause(self.actor,"Stage Clear!",(0,255,0),MSG_STAGECLEAR) )
             GAME.curlevel += 1
-        elif msg["msg"] == "stageclear":
-            self.terminated = True
-            self.actor.addBehavior( BhPlayerPause(self.actor,"Press Space",color=(255,0,255),msg="playerspawn") )
-        elif msg["msg"] == "blastplayer":
-            v,d = msg["vec"],msg.get("pw",500.0)            
-            c = msg.get("o",None)
+        elif msg.id == MSG_STAGECLEAR:
+            self.terminate()
+            self.actor.addBehavior( BhPlayerPause(self.actor,"Press Space",color=(255,0,255),msg=MSG_PLAYERSPAWN) )
+        elif msg.id == MSG_BLASTPLAYER:
+            v,d = msg.vec,msg.value or 500.0
+            c = msg.org
             if c : self.actor.x,self.actor.y = c[0]-self.actor.rect.width/2,c[1]-self.actor.rect.height/2
             self.vx, self.vy = v[0]*d, v[1]*d
-            self.blasting = msg.get("bt",0.1)
+            self.blasting = 0.1
             self.gtime = 0.0
     
     def update(self,dt):
-        self.actor.x += self.vx*dt
-        self.actor.y += self.vy*dt        
-        xbounds = ( 0, GAME.SCREENRECT.right - self.actor.rect.width )
-        ybounds = ( 0, GAME.SCREENRECT.bottom - self.actor.rect.height*2 )
-        collblock = GAME.collision( (self.actor.x+self.actor.rect.width/2, self.actor.y+self.actor.rect.height/2), \
-                                    Rect( (self.actor.x,self.actor.y), self.actor.rect.size ) )        
+        w, h = self.actor.rect.size
+        x0, y0 = self.actor.x, self.actor.y
+        dx, dy = self.vx*dt, self.vy*dt
+        self.actor.x += dx
+        self.actor.y += dy
+        xbounds = ( 0, GAME.SCREENRECT.right - w )
+        ybounds = ( 0, GAME.SCREENRECT.bottom - h*2 )
+        collblock = GAME.collision( (self.actor.x+w/2, self.actor.y+h/2), Rect( (self.actor.x,self.actor.y), (w,h) ) )
+        normal = None
+        # a long step could go right through the first block on the way:
+        # then it stops there, as if it had been taken in small ones
+        hit = GAME.sweep( x0, y0, w, h, dx, dy )
+        if hit:
+            r = hit[2].rect
+            if not ( self.actor.x < r.right and self.actor.x+w > r.left and \
+                     self.actor.y < r.bottom and self.actor.y+h > r.top ):
+                toi, normal, collblock = hit
+                self.actor.x, self.actor.y = x0+dx*toi, y0+dy*toi
         if collblock:
-            collblock.sendMessage( {"msg":"collision","player":self.actor, "vec":(self.vx,self.vy)} )
-            GAME.sendMessage({"msg":"updatebounces","bounces":1})
+            collblock.sendMessage( Message(MSG_COLLISION,player=self.actor,vec=(self.vx,self.vy)) )
+            GAME.postMessage( Message(MSG_UPDATEBOUNCES,value=1) )
             if collblock.response:
                 self.blasting = 0.0
                 xt, yt = self.actor.x, self.actor.y
-                if math.fabs( self.actor.rect.centerx - collblock.rect.centerx ) <= \
-                   math.fabs( self.actor.rect.centery - collblock.rect.centery ):
-                    xt += self.actor.rect.width/2
-                    if self.actor.rect.top > collblock.rect.top:
+                if normal is None: normal = self.side(collblock)
+                if normal[1]:
+                    xt += w/2
+                    if normal[1] > 0:
                         ybounds = ( collblock.rect.bottom, ybounds[1] )
                     else:
-                        ybounds = ( 0, collblock.rect.top-self.actor.rect.height )
-                        yt += self.actor.rect.height
+                        ybounds = ( 0, collblock.rect.top-h )
+                        yt += h
                 else:
-                    yt += self.actor.rect.height/2
-                    if self.actor.rect.right < collblock.rect.right:
-                        xt += self.actor.rect.width
-                        xbounds = ( 0, collblock.rect.left-self.actor.rect.width )
+                    yt += h/2
+                    if normal[0] < 0:
+                        xt += w
+                        xbounds = ( 0, collblock.rect.left-w )
                     else:
                         xbounds = ( collblock.rect.right, xbounds[1] )
                 createAnim( xt, yt, "t" )
@@ -663,7 +2092,7 @@ class BhPlayer:
         self.blasting -= dt        
         if self.actor.y == ybounds[0] or self.actor.y == ybounds[1]: 
             if self.actor.y == ybounds[1] and ybounds[1] == (GAME.SCREENRECT.bottom - self.actor.rect.height*2):
-                GAME.sendMessage( {"msg":"playerdie"} )
+                GAME.sendMessage( Message(MSG_PLAYERDIE) )
             self.vy *= -1.0
             if self.vy < 0.0:
                 self.gtime = 0.0
@@ -689,201 +2118,283 @@ class BhPlayer:
             
         self.vx = clamp(self.vx, -1200, 1200)    
 
+    # face of block hit, from where the player was at the start of the frame
+    def side(self,block):
+        r = self.actor.rect
+        if math.fabs( r.centerx - block.rect.centerx ) <= math.fabs( r.centery - block.rect.centery ):
+            return (0, 1) if r.top > block.rect.top else (0, -1)
+        return (-1, 0) if r.right < block.rect.right else (1, 0)
+
 
 # --------------------------------------------------------
 # Acts like a level
 # --------------------------------------------------------
-class BhLevel:
+class BhLevel(Behavior):
+    __slots__ = ("lvlNameSprite","lvlNamePos","pointsSprite","pointsPos","remSprite","remPos",
+                 "bouncesSprite","bouncesPos","remainBlocks","blocks")
     def __init__(self,actor):
-        self.actor = actor        
-        self.deffont = GAME.loadFont("type_writer.ttf", 10)
-        self.fontbig = GAME.loadFont("type_writer.ttf", 12)
+        Behavior.__init__(self,actor)
+        GAME.subscribe( self, MSG_UPDPLAYERSTATS, MSG_UPDATEREMAINS, MSG_STAGECLEAR )
         self.loadLevel()        
         self.updatePoints(0)
         self.updateBounces(0)
         self.updateRemains( )        
         
     def loadLevel(self):
-        filedef = {}
-        execfile( GAME.nextLevel(), filedef )
-        mapdesc,mapdefs,mapinfo = filedef["MAP"], filedef["MAPDEFS"], filedef["INFO"]
-        self.updateLevelInfo( str(GAME.curlevel%len(GAME.levels))+":"+mapinfo["name"] )
-        self.remainBlocks = 0
-        self.blocks = []
-        for x in range(-1,21):
-            self.blocks.append( createBlock( "t", pos=(x*32,14*32)) )
-        for y in range(0,15):
-            for x in range(0,20):
-                b = mapdesc[y][x]
-                if b in ["w","l","b","y","r","m","t","k","p"]:
-                    self.blocks.append( createBlock(b,pos=(x*32,y*32)) )
-                elif b == "s":
-                    GAME.spawnpoint = (x*32,y*32)
-                elif mapdefs.has_key(b):
-                    defs = mapdefs[b]
-                    b = defs[0]
-                    self.blocks.append( createBlock( b, pos=(x*32,y*32), bhs=defs[1] ) )
-                if b == "w" : self.remainBlocks += 1
-        GAME.sendMessage( {"msg":"playerspawn"} )
+        lvl = GAME.loadLevel( GAME.nextLevel() )
+        self.updateLevelInfo( str(GAME.curlevel%len(GAME.levels))+":"+lvl["name"] )
+        self.remainBlocks = lvl["remain"]
+        if lvl["spawn"]: GAME.spawnpoint = lvl["spawn"]
+        self.blocks = GAME.openGroup("level")
+        for b,x,y,bhs in lvl["blocks"]: createBlock(b,pos=(x,y),bhs=bhs)
+        GAME.closeGroup()
+        GAME.sendMessage( Message(MSG_PLAYERSPAWN) )
+        GAME.prefetchLevels()
                     
     def updateLevelInfo(self,name):
-        self.lvlNameSprite = self.fontbig.render(name, 1, (255, 255, 255))
+        self.lvlNameSprite = GAME.renderText("type_writer.ttf", 12, name, (255, 255, 255))
         self.lvlNamePos = self.lvlNameSprite.get_rect()
         self.lvlNamePos.topleft = (10,10)
         
     def updatePoints(self,p):        
-        self.pointsSprite = self.deffont.render("P: " + str(p), 1, (255, 255, 0))
+        self.pointsSprite = GAME.renderText("type_writer.ttf", 10, "P: " + str(p), (255, 255, 0))
         self.pointsPos = self.pointsSprite.get_rect()
         self.pointsPos.topright = (GAME.SCREENRECT.right-10,10)
         
     def updateRemains(self):
-        self.remSprite = self.deffont.render("R: " + str(self.remainBlocks), 1, (255, 255, 0))        
+        self.remSprite = GAME.renderText("type_writer.ttf", 10, "R: " + str(self.remainBlocks), (255, 255, 0))
         self.remPos = self.remSprite.get_rect()
         self.remPos.topright = (GAME.SCREENRECT.right-10,21)
         
     def updateBounces(self,b):
-        self.bouncesSprite = self.deffont.render("B: " + str(b), 1, (255,255,0))
+        self.bouncesSprite = GAME.renderText("type_writer.ttf", 10, "B: " + str(b), (255,255,0))
         self.bouncesPos = self.bouncesSprite.get_rect()
         self.bouncesPos.topright = (GAME.SCREENRECT.right-10,32)
         
     def update(self,dt):
-        GAME.draw( (10,self.lvlNameSprite, self.lvlNamePos) )
-        GAME.draw( (10,self.pointsSprite, self.pointsPos) )
-        GAME.draw( (10,self.remSprite, self.remPos) )
-        GAME.draw( (10,self.bouncesSprite, self.bouncesPos) )
+        GAME.draw( 10, self.lvlNameSprite, self.lvlNamePos )
+        GAME.draw( 10, self.pointsSprite, self.pointsPos )
+        GAME.draw( 10, self.remSprite, self.remPos )
+        GAME.draw( 10, self.bouncesSprite, self.bouncesPos )
         
     def message(self,msg):
-        if msg["msg"] == "updplayerstats":
-            pl = msg["player"]
+        if msg.id == MSG_UPDPLAYERSTATS:
+            pl = msg.player
             self.updatePoints( pl.points )
             self.updateBounces( pl.bounces )
-        elif msg["msg"] == "updateremains":
-            self.remainBlocks += msg["remains"]
+        elif msg.id == MSG_UPDATEREMAINS:
+            self.remainBlocks += msg.value
             if self.remainBlocks == 0:
-                GAME.sendMessage( {"msg":"lastblock"} )              
+                GAME.sendMessage( Message(MSG_LASTBLOCK) )
             self.updateRemains()
-        elif msg["msg"] == "stageclear":
-            for a in self.blocks: 
-                a.terminated = True
-            self.loadLevel()
+        elif msg.id == MSG_STAGECLEAR:
+            if self.blocks: GAME.discardGroup(self.blocks)
+            self.blocks = None
+            self.after(0.0,self.loadLevel) # next frame, once the old blocks are gone
 
 # --------------------------------------------------------
 # Shows a message awaiting for space ("press space" and "stage clear" messages)
 # --------------------------------------------------------
-class BhPlayerPause:
-    def __init__(self,actor,txt,color=(255,0,0),msg=""):
-        self.actor = actor
-        self.font = GAME.loadFont("type_writer.ttf", 24)
-        self.pauseSprite = self.font.render(txt, 1, color,(0,0,0))
+class BhPlayerPause(Behavior):
+    __slots__ = ("pauseSprite","pausePos","msg")
+    def __init__(self,actor,txt,color=(255,0,0),msg=None):
+        Behavior.__init__(self,actor)
+        self.pauseSprite = GAME.renderText("type_writer.ttf", 24, txt, color, (0,0,0))
         self.pausePos = self.pauseSprite.get_rect()
         self.pausePos.center = GAME.SCREENRECT.center
         self.actor.visible = False
         self.msg = msg
         
     def update(self,dt):
-        GAME.draw( (10,self.pauseSprite,self.pausePos) )
+        GAME.draw( 10, self.pauseSprite, self.pausePos )
         if GAME.KEYPRESSED[K_SPACE]:
-            self.terminated = True
+            self.terminate()
             self.actor.addBehavior( BhPlayer(self.actor) )
             self.actor.visible = True
-            GAME.sendMessage( {"msg":self.msg} )
+            GAME.sendMessage( Message(self.msg) )
    
 # --------------------------------------------------------
 # Represents the statistics for player
 # --------------------------------------------------------
-class BhPlayerStatus:
+class BhPlayerStatus(Behavior):
+    __slots__ = ("nextbounce",)
     def __init__(self,actor):
-        self.actor = actor
+        Behavior.__init__(self,actor)
         self.actor.points = 0
         self.actor.bounces = 0
-        self.nextbounce = 0.0
+        self.nextbounce = GAME.now # sim time a bounce counts again
+        GAME.subscribe( self, MSG_PLAYERDIE, MSG_UPDATEPOINTS, MSG_UPDATEBOUNCES, MSG_PLAYERSPAWN )
         
     def message(self,msg):
         updatestats = False
-        if msg["msg"] == "playerdie":
+        if msg.id == MSG_PLAYERDIE:
             self.actor.points -= 5
             if self.actor.points < 0: 
                 self.actor.points = 0
             createTextAnim( -5, self.actor.x+self.actor.rect.width/2,\
                                   self.actor.y+self.actor.rect.height/2 )
             updatestats = True            
-        elif msg["msg"] == "updatepoints":
-            self.actor.points += msg["points"]
-            createTextAnim( msg["points"], self.actor.x+self.actor.rect.width/2,\
+        elif msg.id == MSG_UPDATEPOINTS:
+            self.actor.points += msg.value
+            createTextAnim( msg.value, self.actor.x+self.actor.rect.width/2,\
                                              self.actor.y+self.actor.rect.height/2 )
             updatestats = True
-        elif msg["msg"] == "updatebounces" and self.nextbounce < 0.0:
-            self.nextbounce = 0.2
-            self.actor.bounces += msg["bounces"]
+        elif msg.id == MSG_UPDATEBOUNCES and GAME.now > self.nextbounce:
+            self.nextbounce = GAME.now+0.2
+            self.actor.bounces += msg.value
             updatestats = True
-        elif msg["msg"] == "playerspawn":
+        elif msg.id == MSG_PLAYERSPAWN:
             self.actor.x, self.actor.y = GAME.spawnpoint
             self.actor.x += self.actor.rect.width/2
             self.actor.y += self.actor.rect.height/2
         if updatestats:
-            GAME.sendMessage( { "msg":"updplayerstats", "player":self.actor} )
-            
-    def update(self,dt):
-        self.nextbounce -= dt
+            GAME.postMessage( Message(MSG_UPDPLAYERSTATS,player=self.actor) )
         
 # --------------------------------------------------------
 # Creates an animation
 # --------------------------------------------------------
 def createAnim( x, y, anim, n=6, period=0.01 ):
+    actor = GAME.animPool.acquire()
+    if actor:
+        actor.drawing.reset("t0",pos=(x,y))
+        actor.effect.start(anim,n,period)
+
+def newAnim():
     actor = Actor()    
-    actor.addBehavior( BhDrawing(actor,"t0",pos=(x,y),zord=9) )
-    actor.addBehavior( BhAnim(actor,anim,n,period) )
-    GAME.addActor( actor )
+    actor.drawing = BhDrawing(actor,zord=9)
+    actor.effect = BhAnim(actor)
+    actor.addBehavior( actor.drawing )
+    actor.addBehavior( actor.effect )
+    return actor
 
 # --------------------------------------------------------
 # Creates a points animation
 # --------------------------------------------------------
 def createTextAnim( points, x, y, dur=0.8,col=(255,255,255) ):
+    actor = GAME.textPool.acquire()
+    if actor:
+        actor.drawing.reset()
+        actor.effect.start(points,(x,y),dur,col)
+
+def newTextAnim():
     actor = Actor()
-    actor.addBehavior( BhDrawing(actor,None,zord=9) )
-    actor.addBehavior( BhTextAnim(actor, points, (x,y),dur,col) )
-    GAME.addActor( actor )    
+    actor.drawing = BhDrawing(actor,zord=9)
+    actor.effect = BhTextAnim(actor)
+    actor.addBehavior( actor.drawing )
+    actor.addBehavior( actor.effect )
+    return actor
 
 # --------------------------------------------------------
 # Creates a block
 # --------------------------------------------------------
-def createBlock( bd, pos, bhs=[] ):
+# Behaviors a level may attach to its tiles, by factory id. Each one
+# is built as factory(actor,*args,**kw).
+BHFACTORY = dict( (c.__name__,c) for c in (BhAlternateDeath, BhBlinking, BhBrokenBlock,
+                  BhColliding, BhDeathBlock, BhGestureBlock, BhMoverBlock, BhShaking,
+                  BhSleepingBlock, BhTurningBlock, BhWhiteBlock, BhYellowBlock) )
+BHFACTORY["BhMoverBlock"] = newMover
+
+# Behaviors of each block kind after drawing and colliding, added in order
+BLOCKKINDS = {
+    "b" : [ ("BhBrokenBlock",(),{}) ],
+    "y" : [ ("BhGestureBlock",("yblock","yblock2"),{}), ("BhYellowBlock",(False,),{}) ],
+    "p" : [ ("BhSleepingBlock",(),{}) ],
+    "w" : [ ("BhGestureBlock",("wblock","wblock2"),{}), ("BhWhiteBlock",(),{}) ],
+    "r" : [ ("BhShaking",(),{}), ("BhDeathBlock",(False,),{}) ],
+    "k" : [ ("BhDeathBlock",(False,),{}) ],
+}
+
+def createBlock( bd, pos, bhs=() ):
     actor = Actor()
     actor.addBehavior( BhDrawing(actor,bd+"block",pos) )
     if bd != "t": 
         actor.addBehavior( BhColliding(actor) )
     else:
-        actor.addBehavior( BhMoverBlock(actor,1,8,1,0) )
+        actor.addBehavior( newMover(actor,1,8,1,0) )
         actor.zord = 0    
-    if bd == "b":
-        actor.addBehavior( BhBrokenBlock(actor) )
-    elif bd == "y":
-        actor.addBehavior( BhGestureBlock(actor,"yblock", "yblock2") )
-        actor.addBehavior( BhYellowBlock(actor,False) )
-    elif bd == "p":
-        actor.addBehavior( BhSleepingBlock(actor) )
-    elif bd == "w":
-        actor.addBehavior( BhGestureBlock(actor,"wblock", "wblock2") )
-        actor.addBehavior( BhWhiteBlock(actor) )    
-    elif bd == "r":
-        actor.addBehavior( BhShaking(actor) )
-        actor.addBehavior( BhDeathBlock(actor,False) )
-    elif bd == "k":        
-        actor.addBehavior( BhDeathBlock(actor,False) )
-        
-    if bhs:
-        for b in bhs:
-            actor.addBehavior( eval(b) )
+    for name,args,kw in BLOCKKINDS.get(bd,[]):
+        actor.addBehavior( BHFACTORY[name](actor,*args,**kw) )
+    for name,args,kw in bhs:
+        actor.addBehavior( BHFACTORY[name](actor,*args,**kw) )
     GAME.addActor( actor )
     return actor
 
+# --------------------------------------------------------
+# Compiles a .lvl script into plain data, without running it:
+# only NAME = literal statements are accepted, and MAPDEFS
+# behavior strings must be calls to a BHFACTORY entry with
+# literal arguments. The result holds the blocks to create as
+# (kind, x, y, [(factory id, args, kwargs)]).
+# --------------------------------------------------------
+LEVELVERSION = 1
+BLOCKTILES = "wlbyrmtkp"
+
+def compileBehavior(src):
+    call = ast.parse(src.strip(), mode="eval").body
+    if not isinstance(call,ast.Call) or not isinstance(call.func,ast.Name) or \
+       not BHFACTORY.has_key(call.func.id) or call.starargs or call.kwargs or \
+       not call.args or not isinstance(call.args[0],ast.Name) or call.args[0].id != "actor":
+        raise ValueError("unsupported level behavior: "+src)
+    return ( call.func.id, tuple( ast.literal_eval(a) for a in call.args[1:] ),
+             dict( (k.arg,ast.literal_eval(k.value)) for k in call.keywords ) )
+
+def compileLevel(path):
+    defs = {}
+    for st in ast.parse( open(path).read(), path ).body:
+        if not isinstance(st,ast.Assign) or len(st.targets) != 1 or not isinstance(st.targets[0],ast.Name):
+            raise ValueError("%s:%d: only NAME = literal allowed" % (path,st.lineno))
+        defs[ st.targets[0].id ] = ast.literal_eval(st.value)
+    mapdesc, mapdefs = defs["MAP"], defs.get("MAPDEFS",{})
+    tiles = dict( (k,(v[0],[compileBehavior(b) for b in v[1]])) for k,v in mapdefs.items() )
+    blocks = [ ("t",x*32,14*32,[]) for x in range(-1,21) ]
+    spawn = None
+    for y in range(0,15):
+        for x in range(0,20):
+            b = mapdesc[y][x]
+            if b in BLOCKTILES:
+                blocks.append( (b,x*32,y*32,[]) )
+            elif b == "s":
+                spawn = (x*32,y*32)
+            elif tiles.has_key(b):
+                blocks.append( (tiles[b][0],x*32,y*32,tiles[b][1]) )
+    return { "name":defs["INFO"]["name"], "spawn":spawn, "blocks":blocks,
+             "remain":len([ b for b in blocks if b[0] == "w" ]) }
+
+# compiled level from its .lvlc if it's up to date, else from the source
+def readLevel(path,mtime):
+    try:
+        f = open(path+"c","rb")
+        version, srctime, lvl = marshal.load(f)
+        f.close()
+        if version == LEVELVERSION and srctime == mtime: return lvl
+    except (IOError,EOFError,ValueError,TypeError):
+        pass
+    lvl = compileLevel(path)
+    try:
+        f = open(path+"c","wb")
+        marshal.dump( (LEVELVERSION,mtime,lvl), f )
+        f.close()
+    except IOError:
+        pass # read only data folder, compile every run
+    return lvl
+
+# images a level's blocks start with: block sprites and the names
+# passed to their behaviors
+def levelImages(lvl):
+    names = set()
+    for kind,x,y,bhs in lvl["blocks"]:
+        names.add( kind+"block" )
+        for name,args,kw in BLOCKKINDS.get(kind,[]) + list(bhs):
+            names.update( a for a in args+tuple(kw.values()) if type(a) is str )
+    return sorted(names)
+
 # --------------------------------------------------------
 # Creates the player
 # --------------------------------------------------------
 def createPlayer(img):
     actor = Actor()
     actor.addBehavior( BhDrawing(actor,img,zord=9) )
-    actor.addBehavior( BhPlayerPause(actor,"Press Space",color=(255,0,255),msg="playerspawn") )
+    actor.addBehavior( BhPlayerPause(actor,"Press Space",color=(255,0,255),msg=MSG_PLAYERSPAWN) )
     actor.addBehavior( BhPlayerStatus(actor) )    
     GAME.addActor( actor )
 
@@ -896,13 +2407,24 @@ def createLevel():
     GAME.addActor( actor )
         
 # --------------------------------------------------------
-# Entry point
+# Entry point. The game steps at a fixed SIMSTEP whatever the
+# display rate (fps, the drawing thread's), catching up to
+# MAXSTEPS at once after a hiccup.
 # --------------------------------------------------------
-def main():
+SIMSTEP, MAXSTEPS = 1/60.0, 5
+def main(profile=None,seed=None,level=None,record=None,replay=None,fps=60,vectorize=False,
+         dirtyrects=False,maxdirty=0.5):
     global GAME
     # Initialize
+    if pygame.mixer: pygame.mixer.pre_init(MIXER_FREQ,-16,2,MIXER_BUFFER)
     pygame.init()
-    GAME = GameClass( "block'em! game by Gyakoo", (640,480) )
+    if replay:
+        replay = InputReplay(replay)
+        seed, level = replay.seed, replay.level
+    GAME = GameClass( "block'em! game by Gyakoo", (640,480), profile=profile, seed=seed, fps=fps,
+                      vectorize=vectorize, dirtyrects=dirtyrects, maxdirty=maxdirty )
+    if level: GAME.curlevel = GAME.levels.index(level)
+    if record: record = InputRecorder(record,GAME.seed,GAME.levels[GAME.curlevel])
     #pygame.mouse.set_visible(0)
 
     # Game Objects    
@@ -910,37 +2432,112 @@ def main():
     createPlayer("blocky")
        
     # Main Loop
-    nextkey = 0.0
     finished = False
+    lag = 0.0 # real time not simulated yet
     while not finished:
         # -- CLOCK
-        GAME.clock.tick(60)
-        dt = GAME.clock.get_time()/1000.0
+        GAME.clock.tick()
+        lag = min( lag + GAME.clock.get_time()/1000.0, MAXSTEPS*SIMSTEP )
         
         # -- INPUT
         for event in pygame.event.get():
             if event.type == QUIT:
                 finished = True
                 break
-        GAME.KEYPRESSED = pygame.key.get_pressed()
-        finished = finished or GAME.KEYPRESSED[K_ESCAPE]
-        if (GAME.KEYPRESSED[K_F5] or GAME.KEYPRESSED[K_F4]) and nextkey <= 0.0:
-            GAME.curlevel += 1 if GAME.KEYPRESSED[K_F5] else -1
-            GAME.sendMessage({"msg":"stageclear"})
-            nextkey = .5
-        nextkey -= dt
-        
+        keys = pygame.key.get_pressed()
+
         # -- UPDATE
-        GAME.update(dt)
+        while lag >= SIMSTEP and not finished:
+            lag -= SIMSTEP
+            dt = SIMSTEP
+            if replay:
+                frame = replay.read()
+                if frame is None:
+                    finished = True
+                    break
+                keys, dt = frame
+            GAME.input( keys, dt )
+            finished = finished or GAME.KEYPRESSED[K_ESCAPE]
+            GAME.update(dt)
+            if record: record.step(keys,dt,GAME)
+            if replay: replay.verify(GAME)
+        time.sleep( max(SIMSTEP-lag,0.0) )
 
+    if record: record.close()
+    if replay: replay.report()
     GAME.destroy()
     pygame.quit()
 
+# --------------------------------------------------------
+# Headless run: fixed dt, keys from an input source (anything
+# with keys(frame)), as fast as the CPU goes. level is a file
+# name in data/levels, None for the default one. A replay (an
+# InputReplay) brings its own seed, level, keys and dt, and
+# runs to its end.
+# --------------------------------------------------------
+def runHeadless(frames,dt=1/60.0,source=None,level=None,seed=0,record=None,replay=None,**kw):
+    global GAME
+    os.environ.setdefault("SDL_VIDEODRIVER","dummy")
+    pygame.init()
+    if replay: seed, level = replay.seed, replay.level
+    GAME = GameClass( "block'em! headless", (640,480), headless=True, seed=seed, **kw )
+    if level: GAME.curlevel = GAME.levels.index(level)
+    if record: record = InputRecorder(record,seed,GAME.levels[GAME.curlevel])
+    source = source or RandomInput(seed)
+    createLevel()
+    createPlayer("blocky")
+    t = time.time()
+    f = 0
+    while f < frames or replay:
+        keys = source.keys(f)
+        if replay:
+            frame = replay.read()
+            if frame is None: break
+            keys, dt = frame
+        GAME.input( keys, dt )
+        GAME.update(dt)
+        if record: record.step(keys,dt,GAME)
+        if replay: replay.verify(GAME)
+        f += 1
+    if record: record.close()
+    GAME.frames = f
+    GAME.elapsed = time.time()-t
+    GAME.ticksPerSecond = f/max(GAME.elapsed,1e-9)
+    return GAME
+
 # Game when this script is executed, not imported
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="block'em!")
+    parser.add_argument("--headless", action="store_true", help="simulate only, no window")
+    parser.add_argument("--frames", type=int, default=6000, help="ticks to simulate when headless")
+    parser.add_argument("--dt", type=float, default=1/60.0, help="fixed time step when headless")
+    parser.add_argument("--level", default=None, help="level file name, e.g. 001.lvl")
+    parser.add_argument("--seed", type=int, default=None, help="rng seed, 0 when headless, random otherwise")
+    parser.add_argument("--record", default=None, help="record keys and dt to this file")
+    parser.add_argument("--replay", default=None, help="play a recording back, checking it doesn't diverge")
+    parser.add_argument("--profile", default=None, help="profile behaviors, csv written on exit")
+    parser.add_argument("--build-atlas", action="store_true", help="pack data/ images in atlas sheets")
+    parser.add_argument("--vectorize", action="store_true", help="move the mover blocks with numpy")
+    parser.add_argument("--fps", type=int, default=60, help="display rate, the game steps at 60 Hz anyway")
+    parser.add_argument("--dirty", action="store_true", help="repaint only the regions that changed")
+    parser.add_argument("--maxdirty", type=float, default=0.5, help="changed screen share above which --dirty redraws it all")
+    args = parser.parse_args()
     try:
-        main()
+        if args.build_atlas:
+            pygame.init()
+            print "%d sheet(s), %d images" % buildAtlas("data")
+        elif args.headless:
+            replay = InputReplay(args.replay) if args.replay else None
+            g = runHeadless(args.frames,args.dt,level=args.level,seed=args.seed or 0,profile=args.profile,
+                            record=args.record,replay=replay,vectorize=args.vectorize)
+            print "%d ticks in %.2fs: %.0f ticks/s, %d actors" % \
+                  (g.frames, g.elapsed, g.ticksPerSecond, len(g.actors))
+            if replay: replay.report()
+            g.destroy()
+        else:
+            main(args.profile,args.seed,args.level,args.record,args.replay,args.fps,args.vectorize,
+                 args.dirty,args.maxdirty)
     except Exception,e:
-        GAME.destroy()
+        if GAME: GAME.destroy()
         pygame.quit()
         raise e
\ No newline at end of file